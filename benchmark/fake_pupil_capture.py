@@ -0,0 +1,122 @@
+"""
+Local stand-in for Pupil Capture: Pupil Remote plus a frame publisher streaming synthetic eye images.
+Run on its own with `python -m benchmark.fake_pupil_capture --rate 120 --resolution 192x192`.
+"""
+import argparse
+import threading
+import time
+
+import zmq
+from msgpack import packb
+
+from deepvog.synthetic import synthetic_eye_frames
+
+
+class FakePupilCapture:
+    """
+    Answers the Pupil Remote requests used by client_side/pupil_lab.py (SUB_PORT, PUB_PORT, t and
+    notifications) on `remote_port`, and publishes msgpack `frame.eye.0` / `frame.eye.1` messages in
+    the Frame Publisher format at `rate` Hz per eye. Timestamps use the clock answered to `t`.
+    """
+
+    def __init__(self, rate=120.0, resolution=(192, 192), remote_port=50020, pub_port=50021, frame_format="bgr",
+                 unique_frames=120):
+        """
+        :param rate: Frames per second published for each eye.
+        :param resolution: (width, height) of the published frames.
+        :param unique_frames: Number of distinct synthetic frames cycled through per eye.
+        """
+        self.rate = rate
+        self.resolution = tuple(resolution)
+        self.remote_port = remote_port
+        self.pub_port = pub_port
+        self.frame_format = frame_format
+        self.frames = [synthetic_eye_frames(unique_frames, self.resolution, eye) for eye in (0, 1)]
+        self.context = zmq.Context.instance()
+        self._stop = threading.Event()
+        self._threads = []
+        self.published = 0  # Frame pairs published
+        self.notifications = []
+
+    @staticmethod
+    def clock():
+        """
+        Pupil time of the fake capture.
+        """
+        return time.monotonic()
+
+    def start(self):
+        for target in (self._remote, self._publish):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=1)
+
+    def _remote(self):
+        socket = self.context.socket(zmq.REP)
+        socket.bind(f"tcp://127.0.0.1:{self.remote_port}")
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        while not self._stop.is_set():
+            if not dict(poller.poll(100)):
+                continue
+            parts = socket.recv_multipart()
+            request = parts[0].decode()
+            if request == "SUB_PORT":
+                socket.send_string(str(self.pub_port))
+            elif request == "PUB_PORT":
+                socket.send_string(str(self.pub_port + 1))
+            elif request == "t":
+                socket.send_string(repr(self.clock()))
+            elif request.startswith("notify."):
+                self.notifications.append(request)
+                socket.send_string("Notification received")
+            else:
+                socket.send_string("Unknown command.")
+        socket.close(linger=0)
+
+    def _publish(self):
+        socket = self.context.socket(zmq.PUB)
+        socket.bind(f"tcp://127.0.0.1:{self.pub_port}")
+        width, height = self.resolution
+        interval = 1.0 / self.rate
+        next_time = time.monotonic()
+        index = 0
+        while not self._stop.is_set():
+            for eye in (0, 1):
+                frame = self.frames[eye][index % len(self.frames[eye])]
+                topic = f"frame.eye.{eye}"
+                payload = {"topic": topic, "width": width, "height": height, "index": index,
+                           "timestamp": self.clock(), "format": self.frame_format}
+                socket.send_multipart([topic.encode(), packb(payload, use_bin_type=True), frame.tobytes()])
+            self.published += 1
+            index += 1
+            next_time += interval
+            remaining = next_time - time.monotonic()
+            if remaining > 0:
+                time.sleep(remaining)
+            else:
+                next_time = time.monotonic()  # Too slow for the rate, do not try to catch up
+        socket.close(linger=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Pupil Capture publishing synthetic eye frames")
+    parser.add_argument("--rate", type=float, default=120.0, help="Frames per second per eye")
+    parser.add_argument("--resolution", default="192x192", metavar="WxH", help="Frame resolution")
+    parser.add_argument("--remote-port", type=int, default=50020, help="Pupil Remote port")
+    parser.add_argument("--pub-port", type=int, default=50021, help="Frame publisher port")
+    args = parser.parse_args()
+    capture = FakePupilCapture(args.rate, tuple(int(v) for v in args.resolution.lower().split("x")),
+                               args.remote_port, args.pub_port).start()
+    print(f"Publishing {args.resolution} eye frames at {args.rate:g} Hz, Pupil Remote on port {args.remote_port}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        capture.stop()
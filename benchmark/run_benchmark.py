@@ -0,0 +1,276 @@
+"""
+End-to-end benchmark of the whole chain on localhost:
+fake Pupil Capture -> client_side/pupil_lab.py -> sender.py -> server_side/receiver.py -> prediction.py
+-> send_pupil_information.py -> a stand-in for the plugin's receive_info.
+
+    python -m benchmark.run_benchmark --backend stub --duration 30 --output results.json
+    python -m benchmark.run_benchmark --backend onnx --compare results.json
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import zmq
+
+from benchmark.fake_pupil_capture import FakePupilCapture
+from server_side.result_schema import decode_results
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_PORT = 5550  # Bound by server_side/send_pupil_information.py
+# Direction of every compared result: +1 higher is better, -1 lower is better
+COMPARED = {
+    "fps": 1,
+    "end_to_end_p50_ms": -1,
+    "end_to_end_p95_ms": -1,
+    "end_to_end_p99_ms": -1,
+    "server_p95_ms": -1,
+    "drop_rate": -1,
+    "server_cpu_percent": -1,
+}
+_SAMPLE = re.compile(r"^(\w+)(\{[^}]*\})?\s+(\S+)$")
+
+
+class ResultSink:
+    """
+    Stand-in for the Pupil Capture plugin: subscribes to the pupil results the server publishes, decodes them like
+    the plugin does and counts the eye frames they cover. Between start_measuring() and stop_measuring() it also
+    records the end-to-end latency of every eye result: the fake capture's clock when the result arrives minus
+    the capture timestamp it carries.
+    """
+
+    def __init__(self, port=RESULT_PORT):
+        self.socket = zmq.Context.instance().socket(zmq.SUB)
+        self.socket.setsockopt(zmq.SUBSCRIBE, b"")
+        self.socket.connect(f"tcp://localhost:{port}")
+        self.received = 0
+        self.invalid = 0
+        self.first_result = threading.Event()
+        self.latencies = []  # Seconds, eye results received while measuring
+        self._measuring = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def start_measuring(self):
+        self._measuring = True
+
+    def stop_measuring(self):
+        self._measuring = False
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+        self.socket.close(linger=0)
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        while not self._stop.is_set():
+            if dict(poller.poll(100)):
+                try:
+                    message = decode_results(self.socket.recv())
+                except ValueError:
+                    self.invalid += 1
+                    continue
+                if self._measuring:
+                    now = FakePupilCapture.clock()
+                    self.latencies.extend(now - eye.timestamp for eye in message.eyes if eye.timestamp is not None)
+                self.received += len(message.eyes)
+                self.first_result.set()
+
+
+def scrape(port):
+    """
+    :return: {(metric, labels): value} parsed from the server's Prometheus endpoint.
+    """
+    text = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read().decode()
+    samples = {}
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if match:
+            samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+    return samples
+
+
+def process_cpu_seconds(pid):
+    """
+    :return: User + system CPU seconds of a process, None where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def stage_cpu(samples):
+    return {re.search(r'stage="([^"]+)"', labels).group(1): value
+            for (name, labels), value in samples.items() if name == "deepvog_stage_cpu_seconds_total"}
+
+
+def wait_for_metrics(port, server, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with code {server.returncode}")
+        try:
+            return scrape(port)
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError("The server did not start its metrics endpoint in time")
+
+
+def interrupt(process, timeout=10):
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run(args):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    capture = FakePupilCapture(args.rate, tuple(int(v) for v in args.resolution.lower().split("x"))).start()
+    sink = ResultSink().start()
+    server_command = [sys.executable, "receiver.py", "--headless", "--backend", args.backend,
+                      "--metrics-port", str(args.metrics_port), "--log-level", "WARNING"] + args.server_args.split()
+    server = subprocess.Popen(server_command, cwd=os.path.join(ROOT, "server_side"), env=env)
+    client = None
+    try:
+        wait_for_metrics(args.metrics_port, server, args.startup_timeout)
+        client = subprocess.Popen([sys.executable, "pupil_lab.py"], cwd=os.path.join(ROOT, "client_side"), env=env)
+        if not sink.first_result.wait(args.startup_timeout):
+            raise TimeoutError("No pupil result reached the plugin stand-in")
+        time.sleep(args.warmup)
+
+        # Measurement window
+        start_samples = scrape(args.metrics_port)
+        start = time.time()
+        start_published, start_received = capture.published, sink.received
+        start_cpu = {"server": process_cpu_seconds(server.pid), "client": process_cpu_seconds(client.pid)}
+        sink.start_measuring()
+        time.sleep(args.duration)
+        sink.stop_measuring()
+        elapsed = time.time() - start
+        end_samples = scrape(args.metrics_port)
+        published = 2 * (capture.published - start_published)  # Eye frames, the capture publishes both eyes
+        results = sink.received - start_received
+        end_cpu = {"server": process_cpu_seconds(server.pid), "client": process_cpu_seconds(client.pid)}
+    finally:
+        if client is not None:
+            interrupt(client)
+        interrupt(server)
+        sink.stop()
+        capture.stop()
+
+    def delta(name, labels=""):
+        return end_samples.get((name, labels), 0.0) - start_samples.get((name, labels), 0.0)
+
+    def quantile(name, value):
+        return 1000 * end_samples.get((f"deepvog_{name}_seconds", f'{{quantile="{value}"}}'), 0.0)
+
+    def end_to_end(value):
+        return 1000 * float(np.percentile(sink.latencies, value)) if sink.latencies else 0.0
+
+    server_received = delta("deepvog_frames_received_total")  # Eye frames
+    summary = {
+        "config": {"backend": args.backend, "rate": args.rate, "resolution": args.resolution,
+                   "duration": args.duration, "server_args": args.server_args},
+        "published_frames": published,
+        "server_received_frames": server_received,
+        "results": results,
+        "invalid_results": sink.invalid,
+        "fps": results / elapsed,
+        "client_send_rate": server_received / elapsed,
+        # Eye frames published by the capture that never produced a result
+        "drop_rate": 1 - results / published if published else 0.0,
+        "server_drop_rate": 1 - results / server_received if server_received else 0.0,
+        "server_lost_messages": delta("deepvog_messages_lost_total"),
+        # Frames answered by the result cache; the fake capture cycles more distinct frames than it holds
+        "result_cache_hits": delta("deepvog_result_cache_hits_total"),
+        # Capture to the plugin stand-in, over the measurement window only
+        "end_to_end_p50_ms": end_to_end(50),
+        "end_to_end_p95_ms": end_to_end(95),
+        "end_to_end_p99_ms": end_to_end(99),
+        # Server histograms cover the whole server run, warmup included; capture to result published
+        "server_end_to_end_p50_ms": quantile("end_to_end_latency", "0.5"),
+        "server_end_to_end_p95_ms": quantile("end_to_end_latency", "0.95"),
+        "server_end_to_end_p99_ms": quantile("end_to_end_latency", "0.99"),
+        "server_p50_ms": quantile("server_latency", "0.5"),
+        "server_p95_ms": quantile("server_latency", "0.95"),
+        "server_p99_ms": quantile("server_latency", "0.99"),
+        # Recorded once per server run: start to sockets open (model loaded and warm), and start to the first
+        # result, which includes the client startup since the client is launched once the server is ready
+        "server_startup_ms": 1000 * end_samples.get(("deepvog_startup_time_seconds_sum", ""), 0.0),
+        "time_to_first_result_ms": 1000 * end_samples.get(("deepvog_time_to_first_result_seconds_sum", ""), 0.0),
+        "stage_cpu_percent": {stage: 100 * (cpu - stage_cpu(start_samples).get(stage, 0.0)) / elapsed
+                              for stage, cpu in stage_cpu(end_samples).items()},
+    }
+    for name in ("server", "client"):
+        if start_cpu[name] is not None and end_cpu[name] is not None:
+            summary[f"{name}_cpu_percent"] = 100 * (end_cpu[name] - start_cpu[name]) / elapsed
+    return summary
+
+
+def compare(current, previous, max_regression):
+    """
+    Print current vs previous results.
+    :return: Names of the results that regressed by more than max_regression (relative).
+    """
+    regressions = []
+    print(f"{'result':>22} {'previous':>10} {'current':>10} {'change':>8}")
+    for name, direction in COMPARED.items():
+        if name not in current or name not in previous:
+            continue
+        old, new = previous[name], current[name]
+        change = (new - old) / abs(old) if old else 0.0
+        regressed = direction * change < -max_regression
+        print(f"{name:>22} {old:>10.3f} {new:>10.3f} {100 * change:>+7.1f}%{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end DeepVOG streaming benchmark on localhost")
+    parser.add_argument("--backend", default="stub", help="Server inference backend ('stub' runs no model)")
+    parser.add_argument("--server-args", default="", help="Extra receiver.py arguments, e.g. '--grayscale --threads 4'")
+    parser.add_argument("--rate", type=float, default=120.0, help="Frames per second published for each eye")
+    parser.add_argument("--resolution", default="192x192", metavar="WxH", help="Eye frame resolution")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds measured")
+    parser.add_argument("--warmup", type=float, default=3.0, help="Seconds run before measuring")
+    parser.add_argument("--startup-timeout", type=float, default=120.0, help="Seconds to wait for the server")
+    parser.add_argument("--metrics-port", type=int, default=9108, help="Port of the server metrics endpoint")
+    parser.add_argument("--output", default=None, help="Save the results to this JSON file")
+    parser.add_argument("--compare", default=None, help="JSON results of a previous run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.1,
+                        help="Relative change counted as a regression when comparing")
+    args = parser.parse_args()
+
+    summary = run(args)
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare(summary, previous, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
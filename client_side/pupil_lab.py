@@ -2,6 +2,7 @@
 Receive world camera data from Pupil using ZMQ.
 Make sure the frame publisher plugin is loaded and confugured to gray or rgb
 """
+import logging
 import time
 
 import zmq
@@ -19,9 +20,22 @@ req.connect("tcp://{}:{}".format(addr, req_port))
 # ask for the sub port
 req.send_string("SUB_PORT")
 sub_port = req.recv_string()
+# Offset from the Pupil clock to the wall clock, so the server can measure latency from the capture
+req.send_string("t")
+pupil_clock_offset = time.time() - float(req.recv_string())
 
 attend_id = 0
 
+# Shared server (receiver.py --listen), e.g. "tcp://gpu-server:5556". None serves the frames on the local
+# PUSH socket for a receiver on this machine, which publishes the results to the plugin itself.
+SERVER_ADDRESS = None
+results = None
+if SERVER_ADDRESS is not None:
+    sender.connect(SERVER_ADDRESS)
+    # The results of this headset come back on the sender socket, republish them for the plugin
+    results = context.socket(zmq.PUB)
+    results.bind("tcp://localhost:5550")
+
 
 # send notification:
 def notify(notification):
@@ -66,59 +80,50 @@ def has_new_data_available():
     return sub.get(zmq.EVENTS) & zmq.POLLIN
 
 
-recent_world = None
-recent_eye0 = None
-recent_eye1 = None
-
-
 FRAME_FORMAT = "bgr"
+logging.basicConfig(level=logging.INFO)  # logging.DEBUG logs every sent frame
 
+# Wire codec, see sender.configure(). Downscaling to the model resolution (320x240) on the client
+# and sending one channel cuts bandwidth and server decode time.
+sender.configure(codec="jpeg", quality=90, grayscale=True, resize_to=(320, 240))
+
+# Frames counted per eye, for publishers that do not send a frame index
+frame_counts = [0, 0]
 
 # Set the frame format via the Network API plugin
 notify({"subject": "frame_publishing.set_format", "format": FRAME_FORMAT})
 
 try:
     while True:
-        # The subscription socket receives data in the background and queues it for
-        # processing. Once the queue is full, it will stop receiving data until the
-        # queue is being processed. In other words, the code for processing the queue
-        # needs to be faster than the incoming data.
-        # e.g. we are subscribed to scene (30 Hz) and eye images (2x 120 Hz), resulting
-        # in 270 images per second. Displays typically only have a refresh rate of
-        # 60 Hz. As a result, we cannot draw all frames even if the network was fast
-        # enough to transfer them. To avoid that the processing can keep up, we only
-        # display the most recently received images *after* the queue has been emptied.
-        while has_new_data_available():
-            topic, msg = recv_from_sub()
-
-            if topic.startswith("frame.") and msg["format"] != FRAME_FORMAT:
-                print(
-                    f"different frame format ({msg['format']}); "
-                    f"skipping frame from {topic}"
-                )
-                continue
-
-            if topic == "frame.eye.0":
-                recent_eye0 = np.frombuffer(
-                    msg["__raw_data__"][0], dtype=np.uint8
-                ).reshape(msg["height"], msg["width"], 3)
-            if topic == "frame.eye.1":
-                recent_eye1 = np.frombuffer(
-                    msg["__raw_data__"][0], dtype=np.uint8
-                ).reshape(msg["height"], msg["width"], 3)
-
-        if (
-            recent_eye0 is not None and
-            recent_eye1 is not None
-        ):
-            sender.send_frame(recent_eye0, recent_eye1, attend_id)
+        # Every eye frame is forwarded once, as soon as it arrives, at the native camera rate
+        # (120-200 Hz per eye). recv blocks until the next frame, so nothing is polled, slept or resent.
+        # The subscription socket queues frames in the background; if sending falls behind the cameras
+        # the queue fills up and Pupil Capture drops the oldest frames.
+        topic, msg = recv_from_sub()
+
+        if topic.startswith("frame.") and msg["format"] != FRAME_FORMAT:
+            print(
+                f"different frame format ({msg['format']}); "
+                f"skipping frame from {topic}"
+            )
+            continue
+
+        if topic in ("frame.eye.0", "frame.eye.1"):
+            eye = int(topic[-1])
+            frame = np.frombuffer(
+                msg["__raw_data__"][0], dtype=np.uint8
+            ).reshape(msg["height"], msg["width"], 3)
+            frame_index = msg.get("index", frame_counts[eye])
+            frame_counts[eye] += 1
+            # The Pupil timestamp comes back with the result, so the plugin can match it to its frame;
+            # its wall-clock equivalent lets the server measure the end-to-end latency
+            sender.send_eye_frame(frame, eye, attend_id, msg["timestamp"], frame_index,
+                                  msg["timestamp"] + pupil_clock_offset)
             attend_id += 1
-            time.sleep(0.03)
-            # prediction.main(recent_eye0)
-            # cv2.imshow("eye0", recent_eye0)
-            # cv2.imshow("eye1", recent_eye1)
-            # cv2.waitKey(1)
-            # pass  # here you can do calculation on the 3 most recent world, eye0 and eye1 images
+
+            if results is not None:
+                for message in sender.receive_results():
+                    results.send(message)
 except KeyboardInterrupt:
     pass
 finally:
@@ -1,33 +1,34 @@
 import zmq
+from server_side.result_schema import decode_results
 
 # ZeroMQ Context and Socket
 context = zmq.Context()
-socket = context.socket(zmq.PULL)  # PULL socket to receive frames
-socket.connect("localhost:5550")  # Connect to sender's address
+socket = context.socket(zmq.SUB)  # SUB socket to receive every pupil result
+socket.setsockopt(zmq.SUBSCRIBE, b"")
+socket.connect("tcp://localhost:5550")  # Connect to sender's address
 
 
 def receive_info():
     while True:
         try:
-            # TODO the information scaled to network target size(320,240). Need to scale original image size
-            # Receive JSON data from the sender
-            message = socket.recv_json()
-            # id = message['attent_id']
-            # Extract data from the received message
-            center_x = message['x']
-            center_y = message['y']
-            major_axis = message['w']
-            minor_axis = message['h']
-            angle = message['angle']
+            # Binary result message, ellipses in source-camera pixels (see server_side/result_schema.py)
+            message = decode_results(socket.recv())
 
             # Print the received data
-            print(f"Received Ellipse Data:")
-            # print(f"id: {id}\n")
-            print(f"Center: ({center_x}, {center_y})")
-            print(f"Major Axis Length: {major_axis}")
-            print(f"Minor Axis Length: {minor_axis}")
-            print(f"Angle: {angle}\n")
+            print(f"Received Ellipse Data (stream {message.stream_id}, id {message.frame_id}):")
+            for eye in message.eyes:
+                if eye.ellipse is None:
+                    print(f"Eye {eye.eye}: no pupil (timestamp {eye.timestamp})\n")
+                    continue
+                (center_x, center_y), (major_axis, minor_axis), angle = eye.ellipse
+                print(f"Eye {eye.eye}, timestamp {eye.timestamp}, confidence {eye.confidence:.2f}")
+                print(f"Center: ({center_x}, {center_y})")
+                print(f"Major Axis Length: {major_axis}")
+                print(f"Minor Axis Length: {minor_axis}")
+                print(f"Angle: {angle}\n")
 
+        except ValueError as e:
+            print(f"Invalid result message: {e}")
         except zmq.ZMQError as e:
             print(f"ZeroMQ Error: {e}")
             break
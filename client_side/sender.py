@@ -1,3 +1,5 @@
+import json
+import logging
 import zmq
 import cv2
 import time
@@ -11,27 +13,168 @@ socket.bind("tcp://localhost:5555")  # Use the desktop's IP
 poller = zmq.Poller()
 poller.register(socket, zmq.POLLOUT)  # Monitor the socket for send readiness
 
+logger = logging.getLogger(__name__)
+# Messages sent, and skipped because the socket was not ready
+send_stats = {"sent": 0, "not_ready": 0}
 
-def send_frame(frame0, frame1, attent_id):
+# Wire codec settings, change them with configure()
+# codec: 'jpeg', 'png' or 'raw' (uncompressed grayscale bytes)
+# quality: JPEG quality (0-100) or PNG compression level (0-9), None for the default of the codec
+# grayscale: encode a single channel, eye cameras are infrared so no information is lost
+# resize_to: (width, height) to downscale larger frames to before encoding, e.g. the model resolution (320, 240)
+codec_settings = {
+    "codec": "jpeg",
+    "quality": None,
+    "grayscale": False,
+    "resize_to": None,
+}
+# Default and valid range of the quality setting of each compressed codec
+QUALITY_DEFAULTS = {"jpeg": 95, "png": 3}
+QUALITY_RANGES = {"jpeg": (0, 100), "png": (0, 9)}
+
+
+def connect(address):
+    """
+    Send the frames to a shared server (receiver.py --listen) instead of serving them on the local PUSH socket.
+    The frames go out on a DEALER socket, and the server sends the results of this client back on it, so
+    several headsets can share one server; read them with receive_results().
+    :param address: ROUTER endpoint of the server, e.g. "tcp://gpu-server:5556".
+    """
+    global socket
+    poller.unregister(socket)
+    socket.close(linger=0)
+    socket = context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.SNDHWM, 64)  # Frames wait at most a few camera periods for a slow server
+    socket.connect(address)
+    poller.register(socket, zmq.POLLOUT)
+
+
+def receive_results():
+    """
+    :return: List of the result messages (see server_side/result_schema.py) the server has sent back so far,
+             empty unless connect() was called.
+    """
+    results = []
+    if socket.socket_type == zmq.DEALER:
+        while socket.poll(0, zmq.POLLIN):
+            results.append(socket.recv())
+    return results
+
+
+def configure(codec=None, quality=None, grayscale=None, resize_to=None):
+    """
+    Change the wire codec. Every message carries its codec in a header part, so the server
+    decodes whatever the client chose without further configuration.
+    Changing the codec without a quality resets the quality to the default of the new codec.
+    :raises ValueError: On an unknown codec or a quality outside the range of the codec.
+    """
+    if codec is not None:
+        if codec not in ("jpeg", "png", "raw"):
+            raise ValueError(f"Unknown codec '{codec}', use 'jpeg', 'png' or 'raw'")
+        if quality is None and codec != codec_settings["codec"]:
+            codec_settings["quality"] = None
+    if quality is not None:
+        valid_range = QUALITY_RANGES.get(codec or codec_settings["codec"])
+        if valid_range is not None and not valid_range[0] <= quality <= valid_range[1]:
+            raise ValueError(f"Quality {quality} is outside {valid_range[0]}-{valid_range[1]} for "
+                             f"'{codec or codec_settings['codec']}'")
+        codec_settings["quality"] = quality
+    if codec is not None:
+        codec_settings["codec"] = codec
+    if grayscale is not None:
+        codec_settings["grayscale"] = grayscale
+    if resize_to is not None:
+        codec_settings["resize_to"] = tuple(resize_to)
+
+
+def encode_frame(frame):
+    """
+    Encode one eye frame with the current codec settings.
+    :return: (frame_bytes, frame_description) where the description goes into the header.
+    """
+    source_height, source_width = frame.shape[:2]
+    resize_to = codec_settings["resize_to"]
+    # Only downscale: smaller frames (e.g. 192x192 eye cameras) are sent at their native size
+    if resize_to is not None and (source_width > resize_to[0] or source_height > resize_to[1]):
+        frame = cv2.resize(frame, resize_to, interpolation=cv2.INTER_AREA)
+    if (codec_settings["grayscale"] or codec_settings["codec"] == "raw") and frame.ndim == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    quality = codec_settings["quality"]
+    if quality is None:
+        quality = QUALITY_DEFAULTS.get(codec_settings["codec"])
+    if codec_settings["codec"] == "raw":
+        frame_bytes = frame.tobytes()
+    elif codec_settings["codec"] == "png":
+        _, compressed_frame = cv2.imencode('.png', frame, [cv2.IMWRITE_PNG_COMPRESSION, quality])
+        frame_bytes = compressed_frame.tobytes()
+    else:
+        _, compressed_frame = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        frame_bytes = compressed_frame.tobytes()
+
+    description = {
+        "width": frame.shape[1],
+        "height": frame.shape[0],
+        "channels": 1 if frame.ndim == 2 else frame.shape[2],
+        "source_width": source_width,
+        "source_height": source_height,
+    }
+    return frame_bytes, description
+
+
+def send_frame(frame0, frame1, attent_id, capture_time=None, timestamps=None):
+    """
+    Encode and send one frame pair.
+    :param capture_time: Wall-clock time (time.time()) the frames were captured at, used by the server to
+                         measure the end-to-end latency. Defaults to now.
+    :param timestamps: Pupil capture timestamps of frame0 and frame1, sent back with their pupil results.
+    """
+    send_frames([frame0, frame1], [0, 1], attent_id, capture_time, timestamps)
+
+
+def send_eye_frame(frame, eye, attent_id, timestamp=None, frame_index=None, capture_time=None):
+    """
+    Encode and send a single eye frame, as soon as the camera delivered it. The server batches the
+    frames of both eyes, and the results are matched to the frames by their timestamp.
+    :param eye: Eye id, 0 or 1.
+    :param attent_id: Message sequence number, one per message whatever the eye.
+    :param timestamp: Pupil capture timestamp of the frame.
+    :param frame_index: Index of the frame in its eye camera stream.
+    """
+    send_frames([frame], [eye], attent_id, capture_time, None if timestamp is None else [timestamp],
+                None if frame_index is None else [frame_index])
+
+
+def send_frames(frames, eyes, attent_id, capture_time=None, timestamps=None, frame_indices=None):
+    """
+    Encode and send the frames of one message, with their eye ids.
+    """
     try:
-        # Compress the frame using JPEG
-        _, compressed_frame0 = cv2.imencode('.jpg', frame0)
-        _, compressed_frame1 = cv2.imencode('.jpg', frame1)
-        frame_bytes0 = compressed_frame0.tobytes()
-        frame_bytes1 = compressed_frame1.tobytes()
+        # Compress the frames with the configured codec
+        encoded = [encode_frame(frame) for frame in frames]
+        descriptions = [description for _, description in encoded]
+        for i, description in enumerate(descriptions):
+            if timestamps is not None:
+                description["timestamp"] = timestamps[i]
+            if frame_indices is not None:
+                description["frame_index"] = frame_indices[i]
+        header = {
+            "attent_id": attent_id,
+            "codec": codec_settings["codec"],
+            "eyes": list(eyes),
+            "frames": descriptions,
+            "capture_time": time.time() if capture_time is None else capture_time,
+        }
 
         # Use poller to check if socket is ready for sending
         events = dict(poller.poll(0))  # 1-second timeout
         if socket in events and events[socket] == zmq.POLLOUT:
-            print(f"sending information id: {attent_id}")
-            # Send frames and attent_id as multipart message
-            socket.send_multipart([
-                str(attent_id).encode(),  # Convert attent_id to bytes
-                frame_bytes0,
-                frame_bytes1
-            ])
+            logger.debug(f"sending information id: {attent_id}")
+            # Send the header and the frames as multipart message
+            socket.send_multipart([json.dumps(header).encode()] + [frame_bytes for frame_bytes, _ in encoded])
+            send_stats["sent"] += 1
         else:
-            print("Socket not ready for sending.")
+            logger.debug("Socket not ready for sending.")
+            send_stats["not_ready"] += 1
     except Exception as e:
-        print(f"Error sending frames: {e}")
-
+        logger.error(f"Error sending frames: {e}")
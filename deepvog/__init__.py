@@ -0,0 +1,11 @@
+from .model.backends import load_backend, export_onnx, export_tflite
+
+# The model definition imports Keras and TensorFlow, it is only loaded when one of its names is used
+_MODEL_NAMES = ("load_DeepVOG", "DeepVOG_net", "fold_batchnorm", "to_grayscale_input")
+
+
+def __getattr__(name):
+    if name in _MODEL_NAMES:
+        from .model import DeepVOG_model
+        return getattr(DeepVOG_model, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,100 @@
+import cv2
+import numpy as np
+
+# Components smaller than this (in mask pixels) are noise, not a pupil
+MIN_PUPIL_AREA = 12
+# RMS distance (pixels) between the pupil outline and the fitted ellipse at which the fit score drops to exp(-0.5)
+RESIDUAL_SCALE = 1.0
+
+
+def largest_contours(masks):
+    """
+    Outline of the largest external component of every mask.
+    :param masks: uint8 masks (N, H, W), non-zero on the pupil.
+    :return: (contours, moments, shares): the (K, 2) outline points of each largest component (empty
+             when the mask is empty), its raw moments (N, 6) as m00, m10, m01, m20, m11, m02, and the
+             share of the segmented area it holds.
+    """
+    contours = []
+    moments = np.zeros((len(masks), 6), dtype=np.float64)
+    shares = np.zeros(len(masks), dtype=np.float64)
+    for i, mask in enumerate(masks):
+        found, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        if not found:
+            contours.append(np.empty((0, 2), dtype=np.float32))
+            continue
+        found_moments = [cv2.moments(contour) for contour in found]
+        areas = [m["m00"] for m in found_moments]
+        largest = int(np.argmax(areas))
+        m = found_moments[largest]
+        moments[i] = m["m00"], m["m10"], m["m01"], m["m20"], m["m11"], m["m02"]
+        shares[i] = areas[largest] / max(sum(areas), 1e-6)
+        contours.append(found[largest].reshape(-1, 2).astype(np.float32))
+    return contours, moments, shares
+
+
+def fit_ellipses(masks, probabilities=None, min_area=MIN_PUPIL_AREA):
+    """
+    Fit the pupil ellipse of a whole batch of masks from the moments of their largest component.
+    Only the outline extraction runs per mask; the ellipse parameters, the fit residual and the
+    confidence are computed for the whole batch at once.
+    The confidence multiplies how well the ellipse follows the outline (RMS residual), the share of
+    the segmented area held by the component, and the mean softmax pupil probability over the mask
+    when `probabilities` is given.
+    :param masks: uint8 masks (N, H, W) or a single (H, W) mask, non-zero on the pupil.
+    :param probabilities: Optional float pupil probabilities with the shape of masks.
+    :param min_area: Smaller components are rejected.
+    :return: (ellipses, confidences): OpenCV ellipses ((cx, cy), (width, height), angle) in mask pixels,
+             None where no pupil was found, and float32 confidences in [0, 1].
+    """
+    masks = np.asarray(masks)
+    if masks.ndim == 2:
+        masks = masks[None]
+        if probabilities is not None:
+            probabilities = np.asarray(probabilities)[None]
+    if len(masks) == 0:
+        return [], np.zeros(0, dtype=np.float32)
+    contours, moments, shares = largest_contours(masks)
+    m00, m10, m01, m20, m11, m02 = moments.T
+
+    # Centroid and central second moments
+    valid = m00 >= min_area
+    area = np.where(valid, m00, 1)
+    cx = m10 / area
+    cy = m01 / area
+    mu20 = m20 / area - cx * cx
+    mu02 = m02 / area - cy * cy
+    mu11 = m11 / area - cx * cy
+
+    # A filled ellipse with semi-axes (a, b) has the second moments (a^2 / 4, b^2 / 4) along its axes
+    half_difference = (mu20 - mu02) / 2
+    common = np.sqrt(half_difference * half_difference + mu11 * mu11)
+    major = 4 * np.sqrt(np.maximum((mu20 + mu02) / 2 + common, 0))
+    minor = 4 * np.sqrt(np.maximum((mu20 + mu02) / 2 - common, 0))
+    angle = np.degrees(0.5 * np.arctan2(2 * mu11, mu20 - mu02)) % 180
+    determinant = mu20 * mu02 - mu11 * mu11
+    valid &= (minor >= 1) & (determinant > 0)
+
+    # Fit residual: radial distance of every outline point to the ellipse, d^T C^-1 d = 4 on the ellipse
+    lengths = np.array([len(contour) for contour in contours])
+    owner = np.repeat(np.arange(len(masks)), lengths)
+    points = np.concatenate(contours).astype(np.float64)
+    inverse = np.where(valid, 1 / np.where(valid, determinant, 1), 0)
+    dx = points[:, 0] - cx[owner]
+    dy = points[:, 1] - cy[owner]
+    distance = (mu02[owner] * dx * dx - 2 * mu11[owner] * dx * dy + mu20[owner] * dy * dy) * inverse[owner]
+    mean_radius = np.sqrt(major * minor) / 2
+    residual = (np.sqrt(np.maximum(distance, 0)) / 2 - 1) * mean_radius[owner]
+    rms = np.sqrt(np.bincount(owner, residual * residual, minlength=len(masks)) / np.maximum(lengths, 1))
+    confidences = np.exp(-0.5 * (rms / RESIDUAL_SCALE) ** 2) * shares
+
+    # Softmax mass: mean pupil probability over the segmented pixels
+    if probabilities is not None:
+        segmented = masks > 0
+        pupil_mass = np.sum(probabilities, axis=(1, 2), where=segmented, dtype=np.float64)
+        confidences *= pupil_mass / np.maximum(np.count_nonzero(segmented, axis=(1, 2)), 1)
+    confidences = np.where(valid, np.clip(confidences, 0, 1), 0).astype(np.float32)
+
+    ellipses = [((float(cx[i]), float(cy[i])), (float(major[i]), float(minor[i])), float(angle[i]))
+                if valid[i] else None for i in range(len(masks))]
+    return ellipses, confidences
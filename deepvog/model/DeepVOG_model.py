@@ -3,11 +3,11 @@ import numpy as np
 from keras.initializers import glorot_uniform
 from keras import layers
 from keras.layers import Input, Add, Dense, Activation, ZeroPadding2D, BatchNormalization, Flatten, Conv2D, AveragePooling2D, MaxPooling2D, GlobalMaxPooling2D
-from keras.layers import Conv2DTranspose, Concatenate
+from keras.layers import Conv2DTranspose, Concatenate, Layer
 from keras.models import Model, load_model
 import tensorflow as tf
 
-def encoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s = 1, X_skip=0):
+def encoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s = 1, X_skip=0, fused = False):
     
     # defining name basis
     conv_name_base = 'conv_' + block_type + str(stage) + '_'
@@ -17,7 +17,8 @@ def encoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s
     for i in np.arange(layer_num)+1:
         # First component of main path 
         X = Conv2D(filters_num, filter_size , strides = (s,s), padding = 'same', name = conv_name_base + 'main_' + str(i), kernel_initializer = glorot_uniform())(X)
-        X = BatchNormalization(axis = 3, name = bn_name_base + 'main_' + str(i))(X)
+        if not fused:
+            X = BatchNormalization(axis = 3, name = bn_name_base + 'main_' + str(i))(X)
         if i != layer_num:
             X = Activation('relu')(X)
 
@@ -26,11 +27,12 @@ def encoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s
     
     # Down sampling layer
     X_downed = Conv2D(filters_num*2, (2, 2), strides = (2,2), padding = 'valid', name = conv_name_base + 'down', kernel_initializer = glorot_uniform())(X)
-    X_downed = BatchNormalization(axis = 3, name = bn_name_base + 'down')(X_downed)
+    if not fused:
+        X_downed = BatchNormalization(axis = 3, name = bn_name_base + 'down')(X_downed)
     X_downed = Activation('relu')(X_downed)
     return X, X_downed
 
-def decoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s=1, X_jump=0, up_sampling=True):
+def decoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s=1, X_jump=0, up_sampling=True, fused=False):
     # defining name basis
     conv_name_base = 'conv_' + block_type + str(stage) + '_'
     bn_name_base = 'bn_' + block_type + str(stage) + '_'
@@ -45,7 +47,8 @@ def decoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s=
     for i in np.arange(layer_num) + 1:
         X_joined_input = Conv2D(filters_num, filter_size, strides=(s, s), padding='same',
                                 name=conv_name_base + 'main_' + str(i), kernel_initializer=glorot_uniform())(X_joined_input)
-        X_joined_input = BatchNormalization(axis=3, name=bn_name_base + 'main_' + str(i))(X_joined_input)
+        if not fused:
+            X_joined_input = BatchNormalization(axis=3, name=bn_name_base + 'main_' + str(i))(X_joined_input)
         if i != layer_num:
             X_joined_input = Activation('relu')(X_joined_input)
 
@@ -55,7 +58,8 @@ def decoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s=
     if up_sampling:
         X_uped = Conv2DTranspose(filters_num, (2, 2), strides=(2, 2), padding='valid',
                                  name=conv_name_base + 'up', kernel_initializer=glorot_uniform())(X_joined_input)
-        X_uped = BatchNormalization(axis=3, name=bn_name_base + 'up')(X_uped)
+        if not fused:
+            X_uped = BatchNormalization(axis=3, name=bn_name_base + 'up')(X_uped)
         X_uped = Activation('relu')(X_uped)
         return X_uped
     else:
@@ -65,7 +69,8 @@ def decoding_block(X, filter_size, filters_num, layer_num, block_type, stage, s=
 # FullVnet
 # Output layers have 3 channels. The first two channels represent two one-hot vectors (pupil and non-pupil)
 # The third layer contains all zeros in all cases (trivial)
-def DeepVOG_net(input_shape = (240, 320, 3), filter_size= (3,3)):
+# With fused = True the BatchNormalization layers are left out, for the inference graph built by fold_batchnorm
+def DeepVOG_net(input_shape = (240, 320, 3), filter_size= (3,3), fused = False):
     
     X_input = Input(input_shape)
     
@@ -73,25 +78,26 @@ def DeepVOG_net(input_shape = (240, 320, 3), filter_size= (3,3)):
     
     # Encoding Stream
     X_jump1, X_out = encoding_block(X = X_input, X_skip = 0, filter_size= filter_size, filters_num= 16,
-                                      layer_num= 1, block_type = "down", stage = 1, s = 1)
+                                      layer_num= 1, block_type = "down", stage = 1, s = 1, fused = fused)
     X_jump2, X_out = encoding_block(X = X_out, X_skip = X_out, filter_size= filter_size, filters_num= 32,
-                                      layer_num= 1, block_type = "down", stage = 2, s = 1)
+                                      layer_num= 1, block_type = "down", stage = 2, s = 1, fused = fused)
     X_jump3, X_out = encoding_block(X = X_out, X_skip = X_out, filter_size= filter_size, filters_num= 64,
-                                      layer_num= 1, block_type = "down", stage = 3, s = 1)
+                                      layer_num= 1, block_type = "down", stage = 3, s = 1, fused = fused)
     X_jump4, X_out = encoding_block(X = X_out, X_skip = X_out, filter_size= filter_size, filters_num= 128,
-                                      layer_num= 1, block_type = "down", stage = 4, s = 1)
+                                      layer_num= 1, block_type = "down", stage = 4, s = 1, fused = fused)
     
     # Decoding Stream
     X_out = decoding_block(X = X_out, X_jump = 0, filter_size= filter_size, filters_num= 256, 
-                                 layer_num= 1, block_type = "up", stage = 1, s = 1)
+                                 layer_num= 1, block_type = "up", stage = 1, s = 1, fused = fused)
     X_out = decoding_block(X = X_out, X_jump = X_jump4, filter_size= filter_size, filters_num= 256, 
-                                 layer_num= 1, block_type = "up", stage = 2, s = 1)
+                                 layer_num= 1, block_type = "up", stage = 2, s = 1, fused = fused)
     X_out = decoding_block(X = X_out, X_jump = X_jump3, filter_size= filter_size, filters_num= 128, 
-                                 layer_num= 1, block_type = "up", stage = 3, s = 1)
+                                 layer_num= 1, block_type = "up", stage = 3, s = 1, fused = fused)
     X_out = decoding_block(X = X_out, X_jump = X_jump2, filter_size= filter_size, filters_num= 64, 
-                                 layer_num= 1, block_type = "up", stage = 4, s = 1)
+                                 layer_num= 1, block_type = "up", stage = 4, s = 1, fused = fused)
     X_out = decoding_block(X = X_out, X_jump = X_jump1, filter_size= filter_size, filters_num= 32, 
-                                 layer_num= 1, block_type = "up", stage = 5, s = 1, up_sampling = False)
+                                 layer_num= 1, block_type = "up", stage = 5, s = 1, up_sampling = False,
+                                 fused = fused)
     # Output layer operations
     X_out = Conv2D(filters = 3, kernel_size = (1,1) , strides = (1,1), padding = 'valid',
                    name = "conv_out", kernel_initializer = glorot_uniform())(X_out)
@@ -100,8 +106,109 @@ def DeepVOG_net(input_shape = (240, 320, 3), filter_size= (3,3)):
     
     return model
 
-def load_DeepVOG():
+# Grayscale input variant
+# The network is trained on grayscale images copied into 3 identical channels, so a convolution
+# over the 3 channels equals a convolution of the single channel with the kernel summed over the
+# input-channel axis. Only the first layer sees the input, every other weight is copied as is.
+def to_grayscale_input(model):
+    first_conv = model.get_layer('conv_down1_main_1')
+    input_shape = tuple(model.input_shape[1:3]) + (1,)
+    gray_model = DeepVOG_net(input_shape = input_shape, filter_size = first_conv.kernel_size, fused = is_fused(model))
+    
+    # Layers carrying weights have explicit names, identical in both models
+    for layer in gray_model.layers:
+        if not layer.weights:
+            continue
+        weights = model.get_layer(layer.name).get_weights()
+        if layer.name == first_conv.name:
+            weights[0] = weights[0].sum(axis = 2, keepdims = True)
+        layer.set_weights(weights)
+    return gray_model
+
+# BatchNormalization folding
+# At inference BN is a per-channel affine op y = gamma * (x - mean) / sqrt(var + eps) + beta, so it is
+# baked into the kernel and bias of the convolution right before it. Conv2D kernels are laid out as
+# (h, w, in, out) and Conv2DTranspose kernels as (h, w, out, in), the scale is applied on the output axis.
+# The unfused model is the one to train, the fused one only serves inference.
+def is_fused(model):
+    return not any(isinstance(layer, BatchNormalization) for layer in model.layers)
+
+def fold_batchnorm(model):
+    first_conv = model.get_layer('conv_down1_main_1')
+    fused_model = DeepVOG_net(input_shape = tuple(model.input_shape[1:]), filter_size = first_conv.kernel_size, fused = True)
+    bn_names = {layer.name for layer in model.layers if isinstance(layer, BatchNormalization)}
+    
+    for layer in fused_model.layers:
+        if not layer.weights:
+            continue
+        kernel, bias = model.get_layer(layer.name).get_weights()
+        bn_name = 'bn_' + layer.name[len('conv_'):]
+        if bn_name in bn_names:
+            bn = model.get_layer(bn_name)
+            gamma, beta, moving_mean, moving_var = bn.get_weights()
+            scale = gamma / np.sqrt(moving_var + bn.epsilon)
+            if isinstance(layer, Conv2DTranspose):
+                kernel = kernel * scale[np.newaxis, np.newaxis, :, np.newaxis]
+            else:
+                kernel = kernel * scale
+            bias = (bias - moving_mean) * scale + beta
+        layer.set_weights([kernel, bias])
+    return fused_model
+
+def verify_fused(model, fused_model, images = None, atol = 1e-4):
+    # Compare both models on the given images (random ones by default), raise if they disagree
+    if images is None:
+        images = np.random.default_rng(0).random((2,) + tuple(model.input_shape[1:]), dtype = np.float32)
+    max_error = float(np.max(np.abs(model(images, training = False) - fused_model(images, training = False))))
+    if max_error > atol:
+        raise ValueError("Fused model deviates from the original by %g (tolerance %g)" % (max_error, atol))
+    return max_error
+
+# Mask head for inference
+# Replaces the final softmax: the pupil mask is argmax == 1 over the conv_out logits, which is decided by
+# comparing the logits directly (ties resolve to the lower class like np.argmax). The mask is returned as
+# uint8 0/255 with shape (N, H, W, 1), optionally with the float32 pupil probability of the softmax.
+class PupilMaskHead(Layer):
+    def __init__(self, with_probability = False, **kwargs):
+        super().__init__(**kwargs)
+        self.with_probability = with_probability
+    
+    def call(self, logits):
+        non_pupil, pupil, trivial = logits[..., 0:1], logits[..., 1:2], logits[..., 2:3]
+        is_pupil = tf.logical_and(pupil > non_pupil, pupil >= trivial)
+        # uint8 arithmetic is not available in TFLite, scale in float before the cast
+        mask = tf.cast(tf.cast(is_pupil, tf.float32) * 255.0, tf.uint8)
+        if not self.with_probability:
+            return mask
+        probability = tf.exp(pupil - tf.reduce_logsumexp(logits, axis = -1, keepdims = True))
+        return mask, probability
+    
+    def get_config(self):
+        config = super().get_config()
+        config.update({"with_probability": self.with_probability})
+        return config
+
+def add_mask_head(model, with_probability = False):
+    logits = model.get_layer('conv_out').output
+    outputs = PupilMaskHead(with_probability = with_probability, name = 'mask_head')(logits)
+    return Model(inputs = model.input, outputs = outputs, name = 'Pupil_mask')
+
+# head: 'softmax' (original output), 'mask' (uint8 mask) or 'mask_prob' (uint8 mask and pupil probability)
+# input_size: (height, width) of the input, the network is fully convolutional so the weights fit any size
+# that survives the four 2x down-samplings, i.e. any multiple of 16
+def load_DeepVOG(channels = 3, fuse_bn = False, verify = False, head = 'softmax', input_size = (240, 320)):
+    if input_size[0] % 16 or input_size[1] % 16:
+        raise ValueError("DeepVOG input size must be a multiple of 16, got %s" % (input_size,))
     base_dir = os.path.dirname(__file__)
-    model = DeepVOG_net(input_shape = (240, 320, 3), filter_size= (10,10))
+    model = DeepVOG_net(input_shape = tuple(input_size) + (3,), filter_size= (10,10))
     model.load_weights(os.path.join(base_dir, "DeepVOG_weights.h5"))
+    if channels == 1:
+        model = to_grayscale_input(model)
+    if fuse_bn:
+        fused_model = fold_batchnorm(model)
+        if verify:
+            verify_fused(model, fused_model)
+        model = fused_model
+    if head != 'softmax':
+        model = add_mask_head(model, with_probability = (head == 'mask_prob'))
     return model
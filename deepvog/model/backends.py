@@ -0,0 +1,237 @@
+import os
+import numpy as np
+from .model_cache import cached_model_path, build_cached
+
+# TensorFlow and Keras are imported by the backends that need them, so the ONNX and stub backends start
+# without loading TensorFlow at all
+# Inference backends share a single `infer(batch)` interface:
+# batch is a float array of shape (N, H, W, C) in [0, 1] with C = 3, or C = 1 for the
+# grayscale variant, the result is the (N, H, W, 3) softmax output of DeepVOG_net as a
+# float32 NumPy array. Models built with a mask head (load_DeepVOG(head='mask')) return the
+# (N, H, W, 1) uint8 pupil mask instead, or a (mask, probability) tuple for head='mask_prob'.
+# H x W is 240 x 320 unless the backend is built with another input_size.
+
+base_dir = os.path.dirname(__file__)
+
+
+def default_model_path(extension, channels=3, suffix="", head="softmax", input_size=(240, 320)):
+    """
+    Default location of an exported model, e.g. DeepVOG.onnx or DeepVOG_gray_mask_128x128.onnx.
+    """
+    name = "DeepVOG" + ("_gray" if channels == 1 else "") + ("" if head == "softmax" else "_" + head)
+    if tuple(input_size) != (240, 320):
+        name += "_%dx%d" % tuple(input_size)
+    name += suffix
+    return os.path.join(base_dir, name + extension)
+
+
+def export_saved_model(model, model_path):
+    """
+    Serialize a Keras model as a TensorFlow SavedModel whose `serve` function is traced once, for a dynamic
+    batch size, so loading it skips building the graph, loading the weights and tracing.
+    """
+    model.export(model_path, format="tf_saved_model", verbose=False)
+    print(f"Exported SavedModel to {model_path}")
+    return model_path
+
+
+def export_path(extension, channels=3, head="softmax", input_size=(240, 320), suffix=""):
+    """
+    Where a backend looks for its exported model when no model_path is given: the model cache entry of the
+    current weights, or default_model_path() when there is no weights file (pre-exported models only).
+    :param suffix: Variant of the export, e.g. '_int8' for the quantized TFLite model; part of the cache key.
+    """
+    options = {"channels": channels, "head": head, "input_size": tuple(input_size)}
+    if suffix:
+        options["suffix"] = suffix
+    return (cached_model_path(extension, **options)
+            or default_model_path(extension, channels, suffix, head=head, input_size=input_size))
+
+
+class KerasBackend:
+    name = "keras"
+
+    def __init__(self, model=None, device=None, num_threads=None, channels=3, fuse_bn=True, head="softmax",
+                 input_size=(240, 320), cache=True):
+        """
+        :param model: Keras model to run, defaults to load_DeepVOG(channels).
+        :param device: Optional TensorFlow device string such as '/GPU:0'; None lets TensorFlow decide.
+        :param num_threads: Intra-op thread count, must be set before TensorFlow runs anything.
+        :param fuse_bn: Fold BatchNormalization into the convolutions (checked against the unfused model at load).
+        :param head: Output head, 'softmax', 'mask' or 'mask_prob' (see load_DeepVOG).
+        :param input_size: (height, width) the model is built for, any multiple of 16.
+        :param cache: Without a model, load the serialized model from the cache (see model_cache.py), built
+                      and saved on first use, instead of building it at every start.
+        """
+        import tensorflow as tf
+        if num_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        self.device = device
+        model_path = None
+        if model is None and cache:
+            model_path = cached_model_path(".savedmodel", backend="keras", channels=channels, fuse_bn=fuse_bn,
+                                           head=head, input_size=tuple(input_size))
+        if model_path is not None:
+            if not os.path.exists(model_path):
+                from .DeepVOG_model import load_DeepVOG
+                model = load_DeepVOG(channels, fuse_bn=fuse_bn, verify=fuse_bn, head=head, input_size=input_size)
+                build_cached(model_path, lambda path: export_saved_model(model, path))
+            self.model = tf.saved_model.load(model_path)
+            self._predict = self.model.serve
+        else:
+            if model is None:
+                from .DeepVOG_model import load_DeepVOG
+                model = load_DeepVOG(channels, fuse_bn=fuse_bn, verify=fuse_bn, head=head, input_size=input_size)
+            self.model = model
+            self._predict = tf.function(lambda x: self.model(x, training=False), reduce_retracing=True)
+
+    def infer(self, batch):
+        import tensorflow as tf
+        batch = tf.convert_to_tensor(batch, dtype=tf.float32)
+        if self.device is None:
+            outputs = self._predict(batch)
+        else:
+            with tf.device(self.device):
+                outputs = self._predict(batch)
+        if isinstance(outputs, (tuple, list)):
+            return tuple(output.numpy() for output in outputs)
+        return outputs.numpy()
+
+
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, model_path=None, num_threads=None, channels=3, head="softmax", input_size=(240, 320)):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The 'onnx' backend requires onnxruntime: pip install onnxruntime")
+        model_path = model_path or export_path(".onnx", channels, head, input_size)
+        if not os.path.exists(model_path):
+            build_cached(model_path, lambda path: export_onnx(model_path=path, channels=channels, head=head,
+                                                              input_size=input_size))
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def infer(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        outputs = self.session.run(None, {self.input_name: batch})
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class TFLiteBackend:
+    name = "tflite"
+
+    def __init__(self, model_path=None, num_threads=None, channels=3, head="softmax", input_size=(240, 320)):
+        import tensorflow as tf
+        model_path = model_path or export_path(".tflite", channels, head, input_size)
+        if not os.path.exists(model_path):
+            build_cached(model_path, lambda path: export_tflite(model_path=path, channels=channels, head=head,
+                                                                input_size=input_size))
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]["index"]
+        # The converter does not keep the Keras output order, the tensor names (":0", ":1") do
+        outputs = sorted(self.interpreter.get_output_details(), key=lambda detail: detail["name"])
+        self.output_indices = [detail["index"] for detail in outputs]
+        self._input_shape = None
+
+    def infer(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        # The interpreter has a static shape, re-allocate only when the batch size changes
+        if batch.shape != self._input_shape:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self._input_shape = batch.shape
+        self.interpreter.set_tensor(self.input_index, batch)
+        self.interpreter.invoke()
+        if len(self.output_indices) == 1:
+            return self.interpreter.get_tensor(self.output_indices[0])
+        return tuple(self.interpreter.get_tensor(index) for index in self.output_indices)
+
+
+def _load_int8(**options):
+    from .quantization import load_int8
+    return load_int8(**options)
+
+
+class StubBackend:
+    """
+    Model-free stand-in for benchmarks and tests: dark pixels are the pupil.
+    Returns outputs shaped like the real heads, so everything around inference runs unchanged.
+    """
+    name = "stub"
+
+    def __init__(self, model_path=None, num_threads=None, channels=3, head="softmax", input_size=(240, 320),
+                 threshold=0.2):
+        self.head = head
+        self.threshold = threshold
+
+    def infer(self, batch):
+        pupil = batch[..., 0] < self.threshold
+        if self.head in ("mask", "mask_prob"):
+            mask = pupil.astype(np.uint8)[..., None] * np.uint8(255)
+            return (mask, pupil.astype(np.float32)[..., None]) if self.head == "mask_prob" else mask
+        outputs = np.zeros(batch.shape[:3] + (3,), dtype=np.float32)
+        outputs[..., 0] = ~pupil
+        outputs[..., 1] = pupil
+        return outputs
+
+
+BACKENDS = {
+    "keras": KerasBackend,
+    "onnx": OnnxBackend,
+    "tflite": TFLiteBackend,
+    "int8": _load_int8,  # Post-training quantized TFLite, see quantization.py
+    "stub": StubBackend,  # No model, for benchmarking the rest of the chain
+}
+
+
+def export_onnx(model=None, model_path=None, opset=13, channels=3, head="softmax", input_size=(240, 320)):
+    """
+    Convert the Keras graph with DeepVOG_weights.h5 to an ONNX file with a dynamic batch dimension.
+    """
+    try:
+        import tf2onnx
+    except ImportError:
+        raise ImportError("Exporting to ONNX requires tf2onnx: pip install tf2onnx")
+    import tensorflow as tf
+    from .DeepVOG_model import load_DeepVOG
+    model = model if model is not None else load_DeepVOG(channels, fuse_bn=True, verify=True, head=head,
+                                                         input_size=input_size)
+    model_path = model_path or default_model_path(".onnx", channels, head=head, input_size=input_size)
+    input_signature = (tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name="input"),)
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=opset, output_path=model_path)
+    print(f"Exported ONNX model to {model_path}")
+    return model_path
+
+
+def export_tflite(model=None, model_path=None, channels=3, head="softmax", input_size=(240, 320)):
+    """
+    Convert the Keras graph with DeepVOG_weights.h5 to a float32 TFLite flatbuffer.
+    """
+    import tensorflow as tf
+    from .DeepVOG_model import load_DeepVOG
+    model = model if model is not None else load_DeepVOG(channels, fuse_bn=True, verify=True, head=head,
+                                                         input_size=input_size)
+    model_path = model_path or default_model_path(".tflite", channels, head=head, input_size=input_size)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    with open(model_path, "wb") as f:
+        f.write(converter.convert())
+    print(f"Exported TFLite model to {model_path}")
+    return model_path
+
+
+def load_backend(name="keras", **options):
+    """
+    Create an inference backend by name ('keras', 'onnx', 'tflite', 'int8' or 'stub').
+    Missing ONNX / TFLite files are exported from the Keras model on first use.
+    :param options: Backend keyword arguments such as model_path, num_threads, channels (3 or 1),
+                    head or input_size.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', choose one of {sorted(BACKENDS)}")
+    return BACKENDS[name](**options)
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+import shutil
+
+# Cache of serialized, ready-to-run models. Building DeepVOG_net, loading DeepVOG_weights.h5, folding
+# the batch normalization and checking the fused model takes seconds at every start; a cached model is
+# loaded instead. Entries are keyed by a hash of the weights file and of the build options, so new
+# weights or options never load a stale model, they build a new entry.
+
+base_dir = os.path.dirname(__file__)
+WEIGHTS_PATH = os.path.join(base_dir, "DeepVOG_weights.h5")
+CACHE_DIR = os.environ.get("DEEPVOG_MODEL_CACHE", os.path.join(base_dir, "cache"))
+
+_weights_hashes = {}  # (path, size, mtime) -> sha256, the weights are hashed once per process
+
+
+def weights_hash(path=WEIGHTS_PATH):
+    """
+    :return: SHA-256 hex digest of the weights file.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _weights_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        _weights_hashes[key] = digest.hexdigest()
+    return _weights_hashes[key]
+
+
+def model_key(**options):
+    """
+    :param options: Build options of the model, e.g. backend, channels, head, input_size.
+    :return: 16 hex characters identifying the weights and the options.
+    """
+    description = json.dumps(dict(options, weights=weights_hash()), sort_keys=True, default=list)
+    return hashlib.sha256(description.encode()).hexdigest()[:16]
+
+
+def cached_model_path(extension, **options):
+    """
+    Path of the cached model built from the current weights with `options`, e.g. cache/DeepVOG_<key>.onnx.
+    :return: The path (the file may not exist yet), or None when there is no weights file to build from.
+    """
+    if not os.path.exists(WEIGHTS_PATH):
+        return None
+    return os.path.join(CACHE_DIR, f"DeepVOG_{model_key(**options)}{extension}")
+
+
+def build_cached(path, build):
+    """
+    Create a cache entry atomically: `build(temporary_path)` writes the model, which is then renamed to
+    `path`, so an interrupted export never leaves a truncated model behind.
+    :return: path
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    root, extension = os.path.splitext(path)
+    temporary = f"{root}.{os.getpid()}.tmp{extension}"
+    try:
+        build(temporary)
+        if not os.path.exists(path):  # Another process may have built the same entry meanwhile
+            os.replace(temporary, path)
+    finally:
+        if os.path.isdir(temporary):
+            shutil.rmtree(temporary, ignore_errors=True)
+        elif os.path.exists(temporary):
+            os.remove(temporary)
+    return path
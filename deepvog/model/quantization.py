@@ -0,0 +1,171 @@
+import os
+import glob
+import time
+import argparse
+import cv2
+import numpy as np
+import tensorflow as tf
+from .DeepVOG_model import load_DeepVOG
+from .backends import KerasBackend, TFLiteBackend, export_path
+from .model_cache import build_cached
+
+# Post-training INT8 quantization of DeepVOG_net.
+# Weights and activations are calibrated on recorded eye images and stored as int8,
+# inputs and outputs stay float32 so the model is a drop-in for the other backends.
+
+base_dir = os.path.dirname(__file__)
+TEST_IMAGE_PATH = os.path.join(base_dir, "test_image.png")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def load_calibration_images(calibration_dir=None, target_size=(240, 320), max_images=200, include_test_image=True,
+                            channels=3):
+    """
+    Load eye images for calibration, preprocessed the same way as the server does.
+    :param calibration_dir: Folder with recorded eye frames (searched recursively), optional.
+    :param target_size: Network input size (height, width).
+    :param max_images: Upper bound on the number of images, evenly subsampled.
+    :param include_test_image: Also use deepvog/model/test_image.png.
+    :param channels: 3 for the original model, 1 for the grayscale variant.
+    :return: Float32 array of shape (N, height, width, channels) in [0, 1].
+    """
+    paths = [TEST_IMAGE_PATH] if include_test_image else []
+    if calibration_dir is not None:
+        found = sorted(p for p in glob.glob(os.path.join(calibration_dir, "**", "*"), recursive=True)
+                       if p.lower().endswith(IMAGE_EXTENSIONS))
+        if len(found) > max_images:
+            found = [found[i] for i in np.linspace(0, len(found) - 1, max_images).astype(int)]
+        paths += found
+
+    # Grayscale files are expanded to 3 identical channels by IMREAD_COLOR
+    read_flag = cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR
+    images = []
+    for path in paths:
+        image = cv2.imread(path, read_flag)
+        if image is None:
+            print(f"Skipping unreadable calibration image: {path}")
+            continue
+        image = cv2.resize(image, (target_size[1], target_size[0]), interpolation=cv2.INTER_AREA)
+        images.append(image.astype(np.float32).reshape(target_size + (channels,)) / 255.0)
+    if not images:
+        raise ValueError("No calibration images found")
+    return np.stack(images)
+
+
+def quantize_int8(model=None, calibration_images=None, model_path=None, channels=3, input_size=(240, 320)):
+    """
+    Convert DeepVOG_net to a full-integer TFLite model calibrated on the given images.
+    :param model: Float Keras model, defaults to load_DeepVOG(channels, input_size=input_size).
+    :param calibration_images: Output of load_calibration_images(), defaults to test_image.png only.
+    :param model_path: Where to write the INT8 flatbuffer, defaults to the model cache entry of the current weights.
+    :param input_size: (height, width) the model is built for, e.g. an ROI window.
+    """
+    model = model if model is not None else load_DeepVOG(channels, input_size=input_size)
+    model_path = model_path or export_path(".tflite", channels, input_size=input_size, suffix="_int8")
+    if calibration_images is None:
+        print("Warning: calibrating on test_image.png only, pass recorded frames for a representative model.")
+        calibration_images = load_calibration_images(target_size=tuple(input_size), channels=channels)
+
+    def representative_dataset():
+        for image in calibration_images:
+            yield [image[np.newaxis]]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.float32
+    converter.inference_output_type = tf.float32
+    os.makedirs(os.path.dirname(model_path) or ".", exist_ok=True)  # The model cache may not exist yet
+    with open(model_path, "wb") as f:
+        f.write(converter.convert())
+    print(f"Exported INT8 model calibrated on {len(calibration_images)} images to {model_path}")
+    return model_path
+
+
+def masks_iou(reference_mask, candidate_mask):
+    """
+    Intersection over union of two boolean pupil masks, two empty masks count as a perfect match.
+    """
+    union = np.logical_or(reference_mask, candidate_mask).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(reference_mask, candidate_mask).sum() / union)
+
+
+def mask_iou(reference, candidate):
+    """
+    Intersection over union of the pupil masks (argmax == 1) of two model outputs.
+    """
+    return masks_iou(np.argmax(reference, axis=-1) == 1, np.argmax(candidate, axis=-1) == 1)
+
+
+def _mean_latency(backend, images, repeats=5):
+    backend.infer(images[:1])  # Warmup, allocates tensors
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for image in images:
+            backend.infer(image[np.newaxis])
+    return (time.perf_counter() - start) / (repeats * len(images))
+
+
+def evaluate_int8(images, model_path=None, reference=None, num_threads=None):
+    """
+    Compare the INT8 model against the float model on a set of images.
+    :param images: Preprocessed images, e.g. from load_calibration_images().
+    :param reference: Float backend to compare against, defaults to the Keras model.
+    :return: Dict with per-image IoU, mean / min IoU and single-image latencies in seconds.
+    """
+    channels = images.shape[-1]
+    model_path = model_path or export_path(".tflite", channels, input_size=images.shape[1:3], suffix="_int8")
+    reference = reference if reference is not None else KerasBackend(num_threads=num_threads, channels=channels)
+    quantized = TFLiteBackend(model_path=model_path, num_threads=num_threads)
+    ious = [mask_iou(reference.infer(image[np.newaxis]), quantized.infer(image[np.newaxis])) for image in images]
+    float_latency = _mean_latency(reference, images)
+    int8_latency = _mean_latency(quantized, images)
+    return {
+        "iou": ious,
+        "mean_iou": float(np.mean(ious)),
+        "min_iou": float(np.min(ious)),
+        "float_latency": float_latency,
+        "int8_latency": int8_latency,
+        "speedup": float_latency / int8_latency,
+    }
+
+
+def load_int8(model_path=None, num_threads=None, channels=3, input_size=(240, 320)):
+    """
+    Load the INT8 model as an inference backend, quantizing it first if the file is missing. Without a
+    model_path the model is taken from the model cache, keyed by the weights, channels and input size.
+    :param input_size: (height, width) the model is built for; window models get their own file.
+    """
+    model_path = model_path or export_path(".tflite", channels, input_size=input_size, suffix="_int8")
+    if not os.path.exists(model_path):
+        build_cached(model_path, lambda path: quantize_int8(model_path=path, channels=channels, input_size=input_size))
+    return TFLiteBackend(model_path=model_path, num_threads=num_threads)
+
+
+if __name__ == "__main__":
+    # Usage: python -m deepvog.model.quantization --calibration-dir recorded_frames/
+    parser = argparse.ArgumentParser(description="Quantize DeepVOG to INT8 and check its accuracy")
+    parser.add_argument("--calibration-dir", default=None, help="Folder of recorded eye frames")
+    parser.add_argument("--eval-dir", default=None, help="Held-out frames for the accuracy check (defaults to calibration set)")
+    parser.add_argument("--output", default=None, help="INT8 model file (defaults to the model cache entry the int8 backend loads)")
+    parser.add_argument("--max-images", type=int, default=200)
+    parser.add_argument("--min-iou", type=float, default=0.9, help="Fail if the mean mask IoU drops below this")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--grayscale", action="store_true", help="Quantize the 1-channel model variant")
+    args = parser.parse_args()
+
+    channels = 1 if args.grayscale else 3
+    calibration_images = load_calibration_images(args.calibration_dir, max_images=args.max_images, channels=channels)
+    quantize_int8(calibration_images=calibration_images, model_path=args.output, channels=channels)
+    eval_images = calibration_images if args.eval_dir is None else load_calibration_images(
+        args.eval_dir, max_images=args.max_images, include_test_image=False, channels=channels)
+    report = evaluate_int8(eval_images, model_path=args.output, num_threads=args.threads)
+
+    print(f"Mask IoU vs float model: mean {report['mean_iou']:.4f}, min {report['min_iou']:.4f}")
+    print(f"Latency per image: float {report['float_latency'] * 1000:.1f} ms, "
+          f"int8 {report['int8_latency'] * 1000:.1f} ms ({report['speedup']:.2f}x)")
+    if report["mean_iou"] < args.min_iou:
+        raise SystemExit(f"INT8 accuracy below threshold ({report['mean_iou']:.4f} < {args.min_iou})")
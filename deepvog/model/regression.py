@@ -0,0 +1,255 @@
+import json
+import time
+import argparse
+import numpy as np
+from ..ellipse_fit import fit_ellipses
+from ..synthetic import synthetic_eye_frames
+from .backends import load_backend
+from .quantization import load_calibration_images, masks_iou
+
+# Accuracy and speed regression harness for the model variants (BN folding, grayscale, mask head, other
+# backends, INT8, other input sizes). Every registered variant runs on test_image.png, synthetic eye images
+# and optionally recorded frames; its pupil masks are compared with the original float Keras model (mask
+# IoU and center error of the pupil ellipse the server fits) and its CPU latency and throughput are measured
+# per batch size.
+# Usage: python -m deepvog.model.regression --images-dir recorded_frames/ --output variants.json
+#        python -m deepvog.model.regression --variants onnx,int8 --compare variants.json
+
+TARGET_SIZE = (240, 320)
+
+# name -> (backend, backend options, minimum mean mask IoU against the reference model)
+VARIANTS = {}
+
+
+def register_variant(name, backend, min_iou=0.99, **options):
+    """
+    Add a model variant to the harness.
+    :param backend: Backend name for deepvog.load_backend().
+    :param min_iou: The variant fails below this mean mask IoU against the reference.
+    :param options: Backend options, e.g. channels, head, fuse_bn or input_size (a window, see crop_windows()).
+    """
+    VARIANTS[name] = (backend, options, min_iou)
+
+
+register_variant("keras_fused", "keras", fuse_bn=True)
+register_variant("keras_gray", "keras", channels=1)
+register_variant("keras_mask", "keras", head="mask")
+register_variant("keras_roi_128x128", "keras", 0.95, input_size=(128, 128))
+register_variant("onnx", "onnx")
+register_variant("onnx_gray", "onnx", channels=1)
+register_variant("tflite", "tflite")
+register_variant("int8", "int8", 0.9)
+
+
+def load_images(images_dir=None, synthetic=16, max_images=200):
+    """
+    :return: Float32 BGR images (N, 240, 320, 3) in [0, 1]: test_image.png, recorded frames from
+             `images_dir` and `synthetic` synthetic eye images.
+    """
+    images = [load_calibration_images(images_dir, TARGET_SIZE, max_images)]
+    if synthetic:
+        frames = synthetic_eye_frames(synthetic, (TARGET_SIZE[1], TARGET_SIZE[0]))
+        images.append(np.stack(frames).astype(np.float32) / 255.0)
+    return np.concatenate(images)
+
+
+def to_channels(images, channels):
+    """
+    Convert BGR images to the channels of a variant, grayscale as the server does (cv2.COLOR_BGR2GRAY).
+    """
+    if channels == 3:
+        return images
+    return np.ascontiguousarray(images @ np.array([0.114, 0.587, 0.299], dtype=np.float32))[..., np.newaxis]
+
+
+def pupil_masks(outputs):
+    """
+    :return: Boolean pupil masks (N, H, W) of any backend output (softmax, mask head or mask and probability).
+    """
+    if isinstance(outputs, tuple):
+        outputs = outputs[0]
+    if outputs.dtype == np.uint8:
+        return outputs[..., 0] > 0
+    return np.argmax(outputs, axis=-1) == 1
+
+
+def pupil_centers(masks):
+    """
+    :return: (x, y) center of the pupil ellipse the server fits on each boolean mask (see
+             deepvog.ellipse_fit), None where no pupil is found.
+    """
+    ellipses, _ = fit_ellipses(np.asarray(masks, dtype=np.uint8))
+    return [None if ellipse is None else np.array(ellipse[0]) for ellipse in ellipses]
+
+
+def crop_windows(images, reference_masks, window_size):
+    """
+    Cut a window around the reference pupil of every image, like the ROI tracking of the server does.
+    :return: (crops, origins): the windows and their (x, y) top-left corners in the images.
+    """
+    window_h, window_w = window_size
+    height, width = images.shape[1:3]
+    crops, origins = [], []
+    for image, center in zip(images, pupil_centers(reference_masks)):
+        if center is None:
+            center = (width / 2, height / 2)
+        x = int(np.clip(round(center[0] - window_w / 2), 0, width - window_w))
+        y = int(np.clip(round(center[1] - window_h / 2), 0, height - window_h))
+        crops.append(image[y:y + window_h, x:x + window_w])
+        origins.append((x, y))
+    return np.stack(crops), origins
+
+
+def infer_masks(backend, images, batch_size=8):
+    return np.concatenate([pupil_masks(backend.infer(images[start:start + batch_size]))
+                           for start in range(0, len(images), batch_size)])
+
+
+def compare_masks(reference_masks, masks, origins=None):
+    """
+    :param origins: Window origins when `masks` are windows of the reference masks (see crop_windows()).
+    :return: Dict with the mean / min mask IoU, the mean / max pupil center error in pixels of the images
+             and the number of images where only one of the models found a pupil.
+    """
+    if origins is not None:
+        height, width = masks.shape[1:3]
+        reference_masks = np.stack([reference[y:y + height, x:x + width]
+                                    for reference, (x, y) in zip(reference_masks, origins)])
+    ious = [masks_iou(reference, mask) for reference, mask in zip(reference_masks, masks)]
+    errors, missed = [], 0
+    for reference_center, center in zip(pupil_centers(reference_masks), pupil_centers(masks)):
+        if (reference_center is None) != (center is None):
+            missed += 1
+        elif center is not None:
+            errors.append(float(np.linalg.norm(center - reference_center)))
+    return {
+        "mean_iou": float(np.mean(ious)),
+        "min_iou": float(np.min(ious)),
+        "mean_center_error": float(np.mean(errors)) if errors else 0.0,
+        "max_center_error": float(np.max(errors)) if errors else 0.0,
+        "missed": missed,
+    }
+
+
+def measure_speed(backend, images, batch_sizes=(1, 4, 16), repeats=5):
+    """
+    CPU latency of one inference call and throughput, per batch size.
+    :return: {batch_size: {"latency_ms": median call latency, "throughput": images per second}}
+    """
+    speed = {}
+    for batch_size in batch_sizes:
+        batch = images[np.arange(batch_size) % len(images)]
+        backend.infer(batch)  # Warmup: traces the graph or allocates the tensors for this batch size
+        latencies = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            backend.infer(batch)
+            latencies.append(time.perf_counter() - start)
+        latency = float(np.median(latencies))
+        speed[batch_size] = {"latency_ms": 1000 * latency, "throughput": batch_size / latency}
+    return speed
+
+
+def evaluate_variants(names, images, batch_sizes=(1, 4, 16), repeats=5, num_threads=None):
+    """
+    Run the reference model and every named variant on the images, one model in memory at a time.
+    :return: {name: {"accuracy": compare_masks() result (not for the reference), "speed": measure_speed()
+             result, "min_iou": threshold}}, with the reference under "reference".
+    """
+    reference = load_backend("keras", num_threads=num_threads, fuse_bn=False, cache=False)
+    reference_masks = infer_masks(reference, images)
+    report = {"reference": {"speed": measure_speed(reference, images, batch_sizes, repeats)}}
+    del reference
+    for name in names:
+        backend_name, options, min_iou = VARIANTS[name]
+        backend = load_backend(backend_name, num_threads=num_threads, **options)
+        variant_images = to_channels(images, options.get("channels", 3))
+        origins = None
+        if tuple(options.get("input_size", TARGET_SIZE)) != TARGET_SIZE:
+            variant_images, origins = crop_windows(variant_images, reference_masks, options["input_size"])
+        report[name] = {
+            "accuracy": compare_masks(reference_masks, infer_masks(backend, variant_images), origins),
+            "speed": measure_speed(backend, variant_images, batch_sizes, repeats),
+            "min_iou": min_iou,
+        }
+        del backend
+    return report
+
+
+def find_regressions(report, max_center_error=1.0, previous=None, max_regression=0.1):
+    """
+    :param previous: Report of an earlier run, to detect throughput regressions.
+    :param max_regression: Relative throughput loss counted as a regression.
+    :return: List of failure messages, empty when every variant passes.
+    """
+    failures = []
+    for name, result in report.items():
+        accuracy = result.get("accuracy")
+        if accuracy is not None:
+            if accuracy["mean_iou"] < result["min_iou"]:
+                failures.append(f"{name}: mean IoU {accuracy['mean_iou']:.4f} < {result['min_iou']}")
+            if accuracy["mean_center_error"] > max_center_error:
+                failures.append(f"{name}: mean center error {accuracy['mean_center_error']:.2f} px "
+                                f"> {max_center_error} px")
+            if accuracy["missed"]:
+                failures.append(f"{name}: pupil found by only one model on {accuracy['missed']} images")
+        old_speed = (previous or {}).get(name, {}).get("speed", {})
+        for batch_size, speed in result["speed"].items():
+            old = old_speed.get(str(batch_size)) or old_speed.get(batch_size)
+            if old and speed["throughput"] < (1 - max_regression) * old["throughput"]:
+                failures.append(f"{name}: batch {batch_size} throughput {speed['throughput']:.1f} images/s, "
+                                f"was {old['throughput']:.1f}")
+    return failures
+
+
+def print_report(report):
+    batch_sizes = list(report["reference"]["speed"])
+    print(f"{'variant':>20} {'mean IoU':>9} {'min IoU':>8} {'center px':>10} {'missed':>6}" +
+          "".join(f" {'b' + str(b) + ' ms':>9} {'b' + str(b) + ' img/s':>10}" for b in batch_sizes))
+    for name, result in report.items():
+        accuracy = result.get("accuracy")
+        columns = (f"{accuracy['mean_iou']:>9.4f} {accuracy['min_iou']:>8.4f} {accuracy['mean_center_error']:>10.2f} "
+                   f"{accuracy['missed']:>6}") if accuracy else f"{'-':>9} {'-':>8} {'-':>10} {'-':>6}"
+        speed = "".join(f" {result['speed'][b]['latency_ms']:>9.1f} {result['speed'][b]['throughput']:>10.1f}"
+                        for b in batch_sizes)
+        print(f"{name:>20} {columns}{speed}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Accuracy and latency regression check of the DeepVOG model variants")
+    parser.add_argument("--variants", default=None,
+                        help=f"Comma-separated variants to check (default all: {','.join(VARIANTS)})")
+    parser.add_argument("--images-dir", default=None, help="Folder of recorded eye frames, used with test_image.png")
+    parser.add_argument("--synthetic", type=int, default=16, help="Number of synthetic eye images")
+    parser.add_argument("--max-images", type=int, default=200)
+    parser.add_argument("--batch-sizes", default="1,4,16", help="Comma-separated batch sizes timed")
+    parser.add_argument("--repeats", type=int, default=5, help="Timed calls per batch size")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--max-center-error", type=float, default=1.0,
+                        help="Fail above this mean pupil center error, in pixels of the 320x240 input")
+    parser.add_argument("--output", default=None, help="Save the report to this JSON file")
+    parser.add_argument("--compare", default=None, help="Report of a previous run to check the throughput against")
+    parser.add_argument("--max-regression", type=float, default=0.1,
+                        help="Relative throughput loss counted as a regression when comparing")
+    args = parser.parse_args()
+
+    names = args.variants.split(",") if args.variants else list(VARIANTS)
+    unknown = [name for name in names if name not in VARIANTS]
+    if unknown:
+        parser.error(f"Unknown variants {unknown}, choose from {sorted(VARIANTS)}")
+    images = load_images(args.images_dir, args.synthetic, args.max_images)
+    print(f"{len(images)} images, reference: float Keras model without BN folding")
+    report = evaluate_variants(names, images, [int(b) for b in args.batch_sizes.split(",")], args.repeats,
+                               args.threads)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    failures = find_regressions(report, args.max_center_error, previous, args.max_regression)
+    if failures:
+        raise SystemExit("Model variant regressions:\n  " + "\n  ".join(failures))
+    print("All variants within thresholds")
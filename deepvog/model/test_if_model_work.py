@@ -12,5 +12,6 @@ def test_if_model_work():
 
 if __name__ == "__main__":
     # If model works, the "test_prediction.png" should show the segmented area of pupil from "test_image.png"
+    # The accuracy and speed of the faster model variants are checked by: python -m deepvog.model.regression
     test_if_model_work()
 
@@ -0,0 +1,22 @@
+import cv2
+import numpy as np
+
+# Synthetic eye frames shared by the benchmark's fake Pupil Capture and the model regression harness
+
+def synthetic_eye_frames(count, resolution, eye=0):
+    """
+    Infrared-like eye images: a noisy gray iris with a dark pupil moving on a circle.
+    :param resolution: (width, height) of the frames.
+    :return: List of `count` BGR uint8 frames.
+    """
+    width, height = resolution
+    rng = np.random.default_rng(eye)
+    frames = []
+    for i in range(count):
+        frame = rng.normal(150, 12, (height, width)).clip(0, 255).astype(np.uint8)
+        phase = 2 * np.pi * i / count + eye
+        center = (width / 2 + width / 8 * np.cos(phase), height / 2 + height / 10 * np.sin(phase))
+        axes = (width / 6, width / 7.5)
+        cv2.ellipse(frame, (center, axes, 30 * np.sin(phase)), 25, -1)
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR))
+    return frames
@@ -13,27 +13,130 @@ from pupil_detector_plugins.detector_base_plugin import (
     PupilDetectorPlugin,
 )
 from pupil_detector_plugins.visualizer_2d import draw_pupil_outline
+import threading
 import zmq
 
-# ZeroMQ Context and Socket
-context = zmq.Context()
-socket = context.socket(zmq.PULL)  # PULL socket to receive frames
-socket.connect("tcp://localhost:5550")  # Connect to sender's address
-
-# Poller setup
-poller = zmq.Poller()
-poller.register(socket, zmq.POLLIN)
+try:
+    # result_schema.py copied next to this plugin
+    from result_schema import decode_results
+except ImportError:
+    from server_side.result_schema import decode_results
 
 logger = logging.getLogger(__name__)
 
-pupil_information_eye0 = None
-pupil_information_eye1 = None
-
-center_x = 0
-center_y = 0
-major_axis = 0
-minor_axis = 0
-angle = 0
+RESULT_ADDRESS = "tcp://localhost:5550"  # Bound by server_side/send_pupil_information.py
+# Results kept per eye, about two seconds of 120 Hz frames
+BUFFER_CAPACITY = 256
+# Largest distance (seconds) between a frame and the result used for it, older results count as no data
+MAX_RESULT_AGE = 0.1
+
+
+class ResultBuffer:
+    """
+    Fixed-capacity ring buffer of one eye's pupil results, ordered by Pupil capture timestamp.
+    Written by the receiver thread, read by detect(); the nearest result is found by binary search.
+    """
+
+    def __init__(self, capacity=BUFFER_CAPACITY):
+        self.capacity = capacity
+        self._timestamps = [0.0] * capacity
+        self._results = [None] * capacity
+        self._start = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        self.out_of_order = 0
+
+    def append(self, timestamp, result):
+        """
+        Add a result; results older than the newest one are dropped.
+        """
+        with self._lock:
+            if self._count and timestamp <= self._timestamps[(self._start + self._count - 1) % self.capacity]:
+                self.out_of_order += 1
+                return
+            index = (self._start + self._count) % self.capacity
+            self._timestamps[index] = timestamp
+            self._results[index] = result
+            if self._count < self.capacity:
+                self._count += 1
+            else:
+                self._start = (self._start + 1) % self.capacity
+
+    def nearest(self, timestamp, max_age=MAX_RESULT_AGE):
+        """
+        :return: The result whose timestamp is closest to `timestamp`, or None if the buffer is empty or
+                 the closest result is more than max_age seconds away.
+        """
+        with self._lock:
+            low, high = 0, self._count
+            while low < high:
+                middle = (low + high) // 2
+                if self._timestamps[(self._start + middle) % self.capacity] < timestamp:
+                    low = middle + 1
+                else:
+                    high = middle
+            best = None
+            for position in (low - 1, low):
+                if 0 <= position < self._count:
+                    index = (self._start + position) % self.capacity
+                    distance = abs(self._timestamps[index] - timestamp)
+                    if best is None or distance < best[0]:
+                        best = (distance, self._results[index])
+        if best is None or best[0] > max_age:
+            return None
+        return best[1]
+
+
+class ResultReceiver:
+    """
+    Background thread draining the server's pupil results into the buffer of one eye, so detect()
+    never waits on the network and never falls behind the result stream.
+    """
+
+    def __init__(self, eye_id, clock, address=RESULT_ADDRESS, capacity=BUFFER_CAPACITY):
+        """
+        :param clock: Returns the current Pupil time, used for results sent without a capture timestamp.
+        """
+        self.eye_id = eye_id
+        self.clock = clock
+        self.buffer = ResultBuffer(capacity)
+        self.received = 0
+        self.invalid = 0
+        self._context = zmq.Context()
+        # Every eye process subscribes to all results and keeps the records of its own eye
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.SUBSCRIBE, b"")
+        self._socket.connect(address)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"deepvog-results-eye{eye_id}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        while not self._stop.is_set():
+            if not dict(poller.poll(100)):
+                continue
+            try:
+                message = decode_results(self._socket.recv())
+            except ValueError as e:
+                self.invalid += 1
+                logger.debug(f"Dropping pupil result: {e}")
+                continue
+            for eye in message.eyes:
+                if eye.eye == self.eye_id:
+                    timestamp = self.clock() if eye.timestamp is None else eye.timestamp
+                    self.buffer.append(timestamp, eye)
+                    self.received += 1
+
+    def nearest(self, timestamp, max_age=MAX_RESULT_AGE):
+        return self.buffer.nearest(timestamp, max_age)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+        self._socket.close(linger=0)
+        self._context.term()
 
 
 class CustomDetector(PupilDetectorPlugin):
@@ -58,6 +161,9 @@ class CustomDetector(PupilDetectorPlugin):
     def __init__(self, g_pool=None):
         super().__init__(g_pool=g_pool)
         self.__detector_2d = Detector2D({})
+        self.__results = ResultReceiver(self.g_pool.eye_id, self.g_pool.get_timestamp)
+        self.__last_ellipse = ((0, 0), (0, 0), 0)  # Last ellipse of this eye, in eye camera pixels
+        self.no_data = 0
         self._stop_other_pupil_detectors()
 
     def _stop_other_pupil_detectors(self):
@@ -77,15 +183,13 @@ class CustomDetector(PupilDetectorPlugin):
                   'method': None, 'timestamp': None, 'norm_pos': None}
 
         eye_id = self.g_pool.eye_id
-        x, y, w, h, temp_angle = self.receive_info(eye_id)
-        # x, y, w, h, temp_angle = 0, 0, 0, 0, 0
+        x, y, w, h, temp_angle, confidence = self.receive_info(frame.timestamp)
         result['ellipse'] = {'center': (x, y),
                              'axes': (w, h),
                              'angle': temp_angle}
         result['diameter'] = w  # The diameter of the circle
         result['location'] = (x, y)  # The center of the circle
-        result['confidence'] = 1  # Confidence is set to 1 for now
-        # print(f"eye_id: {eye_id}, information: {x}, {y}, {w}, {h} ,{temp_angle}")
+        result['confidence'] = confidence  # Ellipse fit confidence computed by the server
 
         result["id"] = eye_id
         result["topic"] = f"pupil.{eye_id}.{self.identifier}"
@@ -94,93 +198,30 @@ class CustomDetector(PupilDetectorPlugin):
         if result['location'] is not None:
             result["norm_pos"] = normalize(result["location"], (frame.width, frame.height), flip_y=True)
 
-        ##with open(r'C:\Users\L1303\Desktop\pupilSource\output.txt', 'w') as f:
-          ##  f.write(str(result))
-
         return result
 
-    def receive_info(self, id):
-        global center_x
-        global center_y
-        global major_axis
-        global minor_axis
-        global angle
-        global pupil_information_eye0
-        global pupil_information_eye1
-
-        # Ensure we always return a tuple, even if no data is received
-        default_result = (0, 0, 0, 0, 0)
-
-        pupil_information_eye0 = [(0, 0), (0, 0), 0]
-        pupil_information_eye1 = [(0, 0), (0, 0), 0]
-        # TODO the information scaled to network target size(320,240). Need to scale original image size
-        # Original and new resolutions
-        original_width, original_height = 320, 240
-        new_width, new_height = 400, 400
-
-        # Scaling factors
-        scale_x = new_width / original_width
-        scale_y = new_height / original_height
-
-        # Poll the socket with a timeout of 1000ms (1 second)
-        events = dict(poller.poll(0))
-
-        if socket in events:
-            # TODO When I send the data, if there is no detection, the system sends a null value.
-            # TODO Therefore, if there is a loss between the first and second frame,
-            # TODO I still need to provide some data to Pupil Capture.
-            # TODO For that reason, I send the previous data if no new data is available,
-            # TODO because the eye’s position wouldn’t change significantly in a single frame.
-            # TODO I didn't work on that part so if you have better solution, please fix that part :D
-            # Receive JSON data from the sender
-            message = socket.recv_json()
-            pupil_info0 = message["info0"]
-            pupil_info1 = message["info1"]
-            if id == 0:
-                if pupil_info0 is not None:
-                    pupil_information_eye0 = pupil_info0
-                    # Extract data from the received message
-                    (center_x, center_y) = pupil_info0[0]
-                    center_x = center_x * scale_x
-                    center_y = center_y * scale_y
-                    (major_axis, minor_axis) = pupil_info0[1]
-                    major_axis = major_axis * scale_y
-                    minor_axis = minor_axis * scale_x
-                    angle = pupil_info0[2]
-                    return center_x, center_y, major_axis, minor_axis, angle
-                else:
-                    (center_x, center_y) = pupil_information_eye0[0]
-                    center_x = center_x * scale_x
-                    center_y = center_y * scale_y
-                    (major_axis, minor_axis) = pupil_information_eye0[1]
-                    major_axis = major_axis * scale_y
-                    minor_axis = minor_axis * scale_x
-                    angle = pupil_information_eye0[2]
-                    return center_x, center_y, major_axis, minor_axis, angle
-            if id == 1:
-                if pupil_info1 is not None:
-                    pupil_information_eye1 = pupil_info1
-                    # Extract data from the received message
-                    (center_x, center_y) = pupil_info1[0]
-                    center_x = center_x * scale_x
-                    center_y = center_y * scale_y
-                    (major_axis, minor_axis) = pupil_info1[1]
-                    major_axis = major_axis * scale_y
-                    minor_axis = minor_axis * scale_x
-                    angle = pupil_info1[2]
-                    return center_x, center_y, major_axis, minor_axis, angle
-                else:
-                    # Extract data from the received message
-                    (center_x, center_y) = pupil_information_eye1[0]
-                    center_x = center_x * scale_x
-                    center_y = center_y * scale_y
-                    (major_axis, minor_axis) = pupil_information_eye1[1]
-                    major_axis = major_axis * scale_y
-                    minor_axis = minor_axis * scale_x
-                    angle = pupil_information_eye1[2]
-                    return center_x, center_y, major_axis, minor_axis, angle
-        else:
-            return default_result
+    def receive_info(self, timestamp):
+        """
+        :param timestamp: Pupil timestamp of the frame being detected.
+        :return: (center_x, center_y, major_axis, minor_axis, angle, confidence) of the result nearest to the
+                 frame, in eye camera pixels. Without a recent result the previous ellipse of this eye is
+                 repeated with zero confidence, since the eye's position barely changes between frames.
+        """
+        eye = self.__results.nearest(timestamp, MAX_RESULT_AGE)
+        if eye is None:
+            self.no_data += 1
+        elif eye.ellipse is not None:
+            self.__last_ellipse = eye.ellipse
+            (center_x, center_y), (major_axis, minor_axis), angle = eye.ellipse
+            return center_x, center_y, major_axis, minor_axis, angle, eye.confidence
+        (center_x, center_y), (major_axis, minor_axis), angle = self.__last_ellipse
+        return center_x, center_y, major_axis, minor_axis, angle, 0
+
+    def cleanup(self):
+        self.__results.stop()
+        logger.info(f"Pupil results received: {self.__results.received}, frames without a recent result: "
+                    f"{self.no_data}")
+        super().cleanup()
 
     def init_ui(self):
         super().init_ui()
@@ -0,0 +1,85 @@
+import json
+import threading
+import cv2
+import numpy as np
+
+# Multipart frame messages from client_side/sender.py:
+#   [header, frame_bytes, ...]  one frame per eye in the message: a single eye frame or a pair
+# header is JSON: {"attent_id": int, "codec": "jpeg" | "png" | "raw", "eyes": [eye id of each frame],
+#                  "frames": [{"width", "height", "channels", "source_width", "source_height", "timestamp",
+#                              "frame_index"}, ...],
+#                  "capture_time": float}
+# "timestamp" is the Pupil capture timestamp of the frame, "timestamp" and "frame_index" are optional.
+# Headers without "eyes" describe a pair, eye 0 then eye 1.
+# Older clients send the attent_id as plain text in place of the header, with JPEG frames.
+
+# Decoded frames, and how many of them needed a new array (raw frames are views on the message)
+decode_stats = {"frames": 0, "allocated": 0}
+_stats_lock = threading.Lock()  # The decode stage runs several threads
+
+
+def _count_decoded(allocated):
+    with _stats_lock:
+        decode_stats["frames"] += 1
+        decode_stats["allocated"] += allocated
+
+
+def parse_header(header_bytes):
+    """
+    Parse the header part of a frame message, accepting the legacy plain attent_id as well.
+    """
+    text = header_bytes.decode()
+    if text.lstrip().startswith("{"):
+        header = json.loads(text)
+        header.setdefault("eyes", [0, 1])
+        return header
+    return {"attent_id": int(text), "codec": "jpeg", "eyes": [0, 1], "frames": [None, None]}
+
+
+def decode_frame(frame_bytes, codec, description, grayscale=False):
+    """
+    Decode one eye frame. Frames the client sent with a single channel stay single-channel (H, W),
+    the preprocessing expands them for a 3-channel model without an extra full-frame copy.
+    :param codec: Codec named in the header.
+    :param description: Frame dimensions from the header (required for 'raw').
+    :param grayscale: Return a single-channel frame, otherwise the frame as sent.
+    """
+    if codec == "raw":
+        # Zero-copy view on the message bytes
+        frame = np.frombuffer(frame_bytes, dtype=np.uint8).reshape(
+            description["height"], description["width"], description["channels"])
+        if description["channels"] == 1:
+            _count_decoded(allocated=0)
+            return frame[:, :, 0]
+        if grayscale:
+            _count_decoded(allocated=1)
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        _count_decoded(allocated=0)
+        return frame
+
+    # OpenCV's imdecode cannot decode into an existing buffer, decode as few channels as possible
+    single_channel = grayscale or (description is not None and description.get("channels") == 1)
+    _count_decoded(allocated=1)
+    return cv2.imdecode(np.frombuffer(frame_bytes, dtype=np.uint8),
+                        cv2.IMREAD_GRAYSCALE if single_channel else cv2.IMREAD_COLOR)
+
+
+def frame_source(frame, description):
+    """
+    :return: ((width, height), timestamp): size of the source camera frame, which the client may have
+             downscaled before encoding, and its Pupil capture timestamp (None if the client did not send it).
+    """
+    if description is None or "source_width" not in description:
+        return (frame.shape[1], frame.shape[0]), None
+    return (description["source_width"], description["source_height"]), description.get("timestamp")
+
+
+def decode_message(parts, grayscale=False):
+    """
+    Decode a multipart frame message.
+    :return: (attent_id, frames, header), one frame per eye of header["eyes"]
+    """
+    header = parse_header(parts[0])
+    frames = [decode_frame(frame_bytes, header["codec"], description, grayscale)
+              for frame_bytes, description in zip(parts[1:], header["frames"])]
+    return header["attent_id"], frames, header
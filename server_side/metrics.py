@@ -0,0 +1,245 @@
+import csv
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram resolution: every power of two is split into SUB_BUCKETS linear buckets (~3% relative error)
+SUB_BUCKETS = 32
+# Values are recorded in microseconds, up to 2^MAX_EXPONENT us (~18 minutes)
+MAX_EXPONENT = 30
+QUANTILES = (0.5, 0.95, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    """
+    HDR-style log-linear latency histogram with a fixed memory footprint.
+    Values below SUB_BUCKETS microseconds are counted exactly, larger values in buckets whose width
+    doubles every power of two, so the relative error stays below 1 / SUB_BUCKETS at any scale.
+    record() is a few integer operations and one counter increment, cheap enough for the hot path.
+    """
+
+    def __init__(self):
+        self._counts = [0] * (SUB_BUCKETS * (MAX_EXPONENT + 1))
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    @staticmethod
+    def _index(microseconds):
+        if microseconds < SUB_BUCKETS:
+            return microseconds
+        shift = microseconds.bit_length() - SUB_BUCKETS.bit_length()
+        return SUB_BUCKETS * shift + (microseconds >> shift)
+
+    @staticmethod
+    def _upper_bound(index):
+        """
+        :return: Largest value (seconds) counted in a bucket.
+        """
+        if index < 2 * SUB_BUCKETS:
+            return index * 1e-6
+        shift = index // SUB_BUCKETS - 1
+        mantissa = index % SUB_BUCKETS + SUB_BUCKETS
+        return (((mantissa + 1) << shift) - 1) * 1e-6
+
+    def record(self, seconds):
+        index = min(self._index(max(int(seconds * 1e6), 0)), len(self._counts) - 1)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, quantile):
+        """
+        :return: The value (seconds) below which `quantile` of the recorded values fall, 0 if empty.
+        """
+        with self._lock:
+            if self.count == 0:
+                return 0.0
+            rank = quantile * self.count
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if count and seen >= rank:
+                    return min(self._upper_bound(index), self.max)
+            return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def snapshot(self):
+        """
+        :return: Dict with the count, sum, mean, max and QUANTILES of the histogram (seconds).
+        """
+        summary = {"count": self.count, "sum": self.total, "mean": self.mean(), "max": self.max}
+        for quantile in QUANTILES:
+            summary[f"p{quantile * 100:g}"] = self.percentile(quantile)
+        return summary
+
+
+class Metrics:
+    """
+    Registry of latency histograms and counters, keyed by name and optional labels.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        return histogram
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record a latency (seconds) in the histogram `name`.
+        """
+        self.histogram(name, **labels).record(seconds)
+
+    def timer(self, name, **labels):
+        """
+        Context manager recording the duration of its block in the histogram `name`.
+        """
+        return _Timer(self.histogram(name, **labels))
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase the counter `name`.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def prometheus_text(self, prefix="deepvog"):
+        """
+        Render every metric in the Prometheus text exposition format: histograms as summaries with
+        their quantiles, counters as *_total.
+        """
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append(f"# TYPE {prefix}_{name}_seconds summary")
+            for (histogram_name, labels), histogram in histograms:
+                if histogram_name != name:
+                    continue
+                summary = histogram.snapshot()
+                for quantile in QUANTILES:
+                    label_text = _labels(labels + (("quantile", f"{quantile:g}"),))
+                    lines.append(f"{prefix}_{name}_seconds{label_text} {summary[f'p{quantile * 100:g}']:.6f}")
+                lines.append(f"{prefix}_{name}_seconds_sum{_labels(labels)} {summary['sum']:.6f}")
+                lines.append(f"{prefix}_{name}_seconds_count{_labels(labels)} {summary['count']}")
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    lines.append(f"{prefix}_{name}_total{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def csv_rows(self):
+        """
+        :return: One (timestamp, metric, labels, count, mean, p50, p95, p99, max) row per histogram and
+                 one (timestamp, metric, labels, value, ...) row per counter.
+        """
+        now = time.time()
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        rows = []
+        for (name, labels), histogram in histograms:
+            summary = histogram.snapshot()
+            rows.append([f"{now:.3f}", name, _labels(labels), summary["count"], f"{summary['mean']:.6f}",
+                         f"{summary['p50']:.6f}", f"{summary['p95']:.6f}", f"{summary['p99']:.6f}",
+                         f"{summary['max']:.6f}"])
+        for (name, labels), value in counters:
+            rows.append([f"{now:.3f}", name, _labels(labels), value, "", "", "", "", ""])
+        return rows
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.record(time.perf_counter() - self._start)
+        return False
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def serve_prometheus(registry, port=9108, host="127.0.0.1"):
+    """
+    Serve the registry in the Prometheus text format on http://host:port/metrics from a daemon thread.
+    :return: The HTTP server, call shutdown() to stop it.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # Scrapes are not worth a log line
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def write_csv_periodically(registry, path, interval=10.0, stop_event=None):
+    """
+    Append a snapshot of the registry to a CSV file every `interval` seconds from a daemon thread.
+    :param stop_event: threading.Event ending the thread; a last snapshot is written when it is set.
+    :return: The thread.
+    """
+    stop_event = stop_event or threading.Event()
+
+    def run():
+        with open(path, "a", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            if csv_file.tell() == 0:
+                writer.writerow(["timestamp", "metric", "labels", "count", "mean", "p50", "p95", "p99", "max"])
+            while True:
+                stopped = stop_event.wait(interval)
+                writer.writerows(registry.csv_rows())
+                csv_file.flush()
+                if stopped:
+                    break
+
+    thread = threading.Thread(target=run, name="metrics-csv", daemon=True)
+    thread.start()
+    return thread
+
+
+# Process-wide registry used by the server modules
+metrics = Metrics()
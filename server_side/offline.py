@@ -0,0 +1,152 @@
+"""
+Offline batch mode: segment the eye videos of a recorded Pupil session as fast as the CPU allows.
+
+    python -m server_side.offline <recording folder> --output pupils.npz --backend onnx
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import zip_longest
+
+import numpy as np
+
+# prediction (and with it TensorFlow) is imported inside the functions that need it: the spawned
+# decode workers re-import this module and must stay light
+from server_side.recording import find_eye_videos, video_frame_count, decode_chunk, open_result_writer
+from server_side.roi import scale_ellipse
+
+TARGET_SIZE = (240, 320)
+logger = logging.getLogger("offline")
+
+
+def chunk_tasks(videos, chunk_frames):
+    """
+    :return: Generator of (eye, video_path, timestamps, start, count) decode tasks, eye videos interleaved.
+    """
+    ranges = []
+    for eye, video_path, timestamps in videos:
+        frame_count = video_frame_count(video_path)
+        total = min(len(timestamps), frame_count) if frame_count > 0 else len(timestamps)
+        ranges.append([(eye, video_path, timestamps, start, min(chunk_frames, total - start))
+                       for start in range(0, total, chunk_frames)])
+    for tasks in zip_longest(*ranges):
+        yield from (task for task in tasks if task is not None)
+
+
+def segment_chunk(model, eye, timestamps, start, frames, source_size, batch_size):
+    """
+    Segment one decoded chunk in batches of `batch_size` frames.
+    :return: Dict of result columns (see recording.RESULT_COLUMNS), ellipses in source-camera pixels.
+    """
+    from server_side import prediction
+    count = len(frames)
+    columns = {
+        "timestamp": timestamps[start:start + count],
+        "eye": np.full(count, eye, dtype=np.uint8),
+        "frame_index": np.arange(start, start + count, dtype=np.int64),
+    }
+    ellipse_columns = np.full((count, 5), np.nan, dtype=np.float32)
+    confidence = np.zeros(count, dtype=np.float32)
+    scale_x, scale_y = source_size[0] / TARGET_SIZE[1], source_size[1] / TARGET_SIZE[0]
+    for batch_start in range(0, count, batch_size):
+        batch = frames[batch_start:batch_start + batch_size]
+        _, ellipses, confidences = prediction.segment_frames(model, batch, [eye] * len(batch), TARGET_SIZE)
+        confidence[batch_start:batch_start + len(batch)] = confidences
+        for i, ellipse in enumerate(ellipses, batch_start):
+            if ellipse is not None:
+                (cx, cy), (axis_a, axis_b), angle = scale_ellipse(ellipse, scale_x, scale_y)
+                ellipse_columns[i] = cx, cy, axis_a, axis_b, angle
+    for i, name in enumerate(("center_x", "center_y", "axis_a", "axis_b", "angle")):
+        columns[name] = ellipse_columns[:, i]
+    columns["confidence"] = confidence
+    return columns
+
+
+def process_recording(recording_dir, output, decode_workers=None, chunk_frames=128, batch_size=32,
+                      grayscale=False):
+    """
+    Decode the eye videos of a recording in worker processes and segment them with the loaded model.
+    At most `decode_workers + 2` decoded chunks are in flight, so memory stays bounded whatever the
+    length of the recording.
+    :param output: Result file, .npz or .parquet.
+    :return: Number of frames processed.
+    """
+    from server_side import prediction
+    videos = find_eye_videos(recording_dir)
+    decode_workers = decode_workers or max(1, (os.cpu_count() or 2) // 2)
+    window = decode_workers + 2
+    frame_bytes = TARGET_SIZE[0] * TARGET_SIZE[1] * (1 if grayscale else 3)
+    logger.info(f"{len(videos)} eye video(s), {decode_workers} decode workers, "
+                f"at most {window * chunk_frames * frame_bytes / 2 ** 20:.0f} MB of decoded frames in flight")
+
+    writer = open_result_writer(output)
+    start_time = time.time()
+    processed = 0
+    # Spawned workers only import the light recording module, not TensorFlow
+    with ProcessPoolExecutor(decode_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        tasks = chunk_tasks(videos, chunk_frames)
+        in_flight = deque()
+        try:
+            while True:
+                while len(in_flight) < window:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    eye, video_path, timestamps, start, count = task
+                    future = executor.submit(decode_chunk, video_path, start, count, TARGET_SIZE, grayscale)
+                    in_flight.append((eye, timestamps, future))
+                if not in_flight:
+                    break
+
+                # Results are consumed in submission order while the workers decode the next chunks
+                eye, timestamps, future = in_flight.popleft()
+                start, frames, source_size = future.result()
+                if len(frames):
+                    writer.write(segment_chunk(prediction.model, eye, timestamps, start, frames, source_size,
+                                               batch_size))
+                processed += len(frames)
+                elapsed = time.time() - start_time
+                logger.info(f"{processed} frames, {processed / elapsed:.1f} frames/s")
+        finally:
+            writer.close()
+    return processed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline DeepVOG segmentation of a Pupil recording")
+    parser.add_argument("recording", help="Pupil recording folder with eye0/eye1 videos and timestamps")
+    parser.add_argument("--output", default=None,
+                        help="Result file (.npz or .parquet), default <recording>/deepvog_pupils.npz")
+    parser.add_argument("--backend", default="keras", choices=["keras", "onnx", "tflite", "int8", "stub"],
+                        help="Inference backend")
+    parser.add_argument("--model-path", default=None, help="ONNX / TFLite / INT8 model file")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads used by the backend")
+    parser.add_argument("--grayscale", action="store_true", help="Infer on a single channel with the folded model")
+    parser.add_argument("--decode-workers", type=int, default=None,
+                        help="Decode processes (default: half of the CPU cores)")
+    parser.add_argument("--chunk-frames", type=int, default=128, help="Frames decoded per worker task")
+    parser.add_argument("--batch-size", type=int, default=32, help="Frames per inference call")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    from server_side import prediction
+
+    backend_options = {"num_threads": args.threads, "channels": 1 if args.grayscale else 3}
+    if args.model_path and args.backend != "keras":
+        backend_options["model_path"] = args.model_path
+    prediction.load_model_once(args.backend, **backend_options)
+    output = args.output or os.path.join(args.recording, "deepvog_pupils.npz")
+    start_time = time.time()
+    processed = process_recording(args.recording, output, args.decode_workers, args.chunk_frames, args.batch_size,
+                                  args.grayscale)
+    elapsed = time.time() - start_time
+    logger.info(f"Wrote {processed} frames to {output} in {elapsed:.1f} s "
+                f"({processed / max(elapsed, 1e-9):.1f} frames/s)")
+
+
+if __name__ == "__main__":
+    main()
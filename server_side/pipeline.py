@@ -0,0 +1,340 @@
+import logging
+import threading
+import time
+from collections import deque
+from server_side.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FrameJob:
+    """
+    One frame message (a single eye frame or a pair) travelling through the pipeline stages.
+    Every stage fills in its own fields; `tracked` jobs were answered by the temporal tracker and
+    `cached` jobs by the result cache, both skip inference.
+    """
+    __slots__ = ("attent_id", "header", "parts", "stream", "received", "frames", "masks", "pupil_info",
+                 "confidences", "tracked", "cache_key", "cached", "source_sizes")
+
+    def __init__(self, attent_id, header, parts, stream=0):
+        self.attent_id = attent_id
+        self.header = header
+        self.parts = parts
+        self.stream = stream
+        self.received = time.perf_counter()
+        self.frames = None
+        self.masks = None
+        self.pupil_info = None
+        self.confidences = None
+        self.tracked = False
+        self.cache_key = None
+        self.cached = False
+        self.source_sizes = None
+
+
+class FairQueue:
+    """
+    FIFO queues per key (e.g. per client stream) served round robin, so a busy stream cannot starve
+    the others. Same interface as the deque of a Stage, for (ticket, item, arrival) entries.
+    """
+
+    def __init__(self, key):
+        """
+        :param key: Callable returning the key of an item.
+        """
+        self.key = key
+        self._queues = {}
+        self._order = deque()  # Keys with queued entries, in serving order
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def count(self, key):
+        queue = self._queues.get(key)
+        return 0 if queue is None else len(queue)
+
+    def append(self, entry):
+        key = self.key(entry[1])
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._order.append(key)
+        queue.append(entry)
+        self._length += 1
+
+    def popleft(self, key=None):
+        """
+        :param key: Pop the oldest entry of this key, default the oldest entry of the next key in turn.
+        """
+        if key is None:
+            key = self._order.popleft()
+            self._order.append(key)
+        queue = self._queues[key]
+        entry = queue.popleft()
+        if not queue:
+            del self._queues[key]
+            self._order.remove(key)
+        self._length -= 1
+        return entry
+
+
+class Stage:
+    """
+    Pipeline stage: a bounded input queue served by a pool of worker threads.
+    Every item gets a ticket when it is queued and results are handed to the next stage in ticket
+    order, so the pipeline keeps the arrival (attent_id) order whatever the number of workers.
+    With max_batch > 1 the handler receives a list of items, gathered until max_batch items are
+    queued or the oldest one has waited max_wait seconds, and returns one result per item.
+    A handler returning None for an item consumes it.
+    With a fair_key, items are queued and ordered per key (e.g. per client stream): every key has its own
+    queue_size bound and the keys are served round robin.
+    """
+
+    def __init__(self, name, handler, workers=1, queue_size=16, max_batch=1, max_wait=0.0, drop_oldest=False,
+                 fair_key=None):
+        """
+        :param name: Stage name used in the statistics.
+        :param handler: Callable taking an item (a list of items with max_batch > 1) and returning the result(s).
+        :param workers: Number of worker threads.
+        :param queue_size: Maximum queued items.
+        :param max_batch: Maximum items per handler call.
+        :param max_wait: Maximum seconds the oldest item may wait for the batch to fill up.
+        :param drop_oldest: When the queue is full, drop the oldest item instead of blocking put().
+        :param fair_key: Callable returning the key of an item, to queue and order the items per key.
+        """
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.drop_oldest = drop_oldest
+        self.next_stage = None
+        self.fair_key = fair_key
+        self._items = deque() if fair_key is None else FairQueue(fair_key)
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        # Reorder buffer: results waiting for the earlier tickets (of the same key) to finish.
+        # Tickets are (key, number), the key is None without fair_key.
+        self._next_ticket = {}
+        self._emit_ticket = {}
+        self._finished = {}
+        self._emit_lock = threading.Condition()
+        # Results in order, forwarded outside the lock by one worker at a time (see _finish)
+        self._outbox = deque()
+        self._forwarding = False
+        # Statistics
+        self.processed = 0
+        self.dropped = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.busy_time = 0.0
+        self.cpu_time = 0.0
+        self.wait_time = 0.0
+        self._service_histogram = metrics.histogram("stage_service", stage=name)
+        self._wait_histogram = metrics.histogram("stage_wait", stage=name)
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=1.0):
+        """
+        Stop the workers; queued items are discarded.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+
+    def put(self, item, timeout=None):
+        """
+        Queue an item. Blocks while the queue is full, unless the stage drops its oldest items.
+        :param timeout: Maximum seconds to wait for room in the queue, None waits forever.
+        :return: False if the stage is stopped or the timeout expired, True otherwise.
+        """
+        dropped_tickets = []
+        key = None if self.fair_key is None else self.fair_key(item)
+        with self._condition:
+            if self.drop_oldest:
+                while self._queued(key) >= self.queue_size:
+                    dropped_tickets.append(self._pop_oldest(key)[0])
+                    self.dropped += 1
+                    metrics.inc("frames_dropped", stage=self.name)
+            elif not self._condition.wait_for(
+                lambda: self._stopped or self._queued(key) < self.queue_size, timeout
+            ):
+                return False
+            if self._stopped:
+                return False
+            number = self._next_ticket.get(key, 0)
+            self._next_ticket[key] = number + 1
+            self._items.append(((key, number), item, time.perf_counter()))
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._condition.notify_all()
+        if dropped_tickets:
+            # Release the tickets so later items are not held back. Every later ticket of the key is still
+            # queued, so the worker that finishes the next one forwards past them; the producer (the socket
+            # receive loop) never blocks on the next stage.
+            with self._emit_lock:
+                for ticket in dropped_tickets:
+                    self._finished[ticket] = None
+        return True
+
+    def depth(self):
+        with self._condition:
+            return len(self._items)
+
+    def _queued(self, key):
+        return len(self._items) if self.fair_key is None else self._items.count(key)
+
+    def _pop_oldest(self, key):
+        return self._items.popleft() if self.fair_key is None else self._items.popleft(key)
+
+    def _take(self):
+        """
+        Wait for the next item (batch of items with max_batch > 1).
+        :return: List of (ticket, item, arrival) entries, or None once stopped.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._stopped or self._items)
+            if self._stopped:
+                return None
+            batch = [self._items.popleft()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch and not self._stopped:
+                if self._items:
+                    batch.append(self._items.popleft())
+                    continue
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            self._condition.notify_all()  # Wake up producers blocked on a full queue
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                break
+            items = [item for _, item, _ in batch]
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                results = self.handler(items) if self.max_batch > 1 else [self.handler(items[0])]
+            except Exception as e:
+                logger.error(f"Error in {self.name} stage: {e}")
+                metrics.inc("stage_errors", stage=self.name)
+                results = [None] * len(items)
+            elapsed = time.perf_counter() - start
+            cpu = time.thread_time() - cpu_start
+            self._service_histogram.record(elapsed)
+            metrics.inc("stage_cpu_seconds", cpu, stage=self.name)
+            for _, _, arrival in batch:
+                self._wait_histogram.record(start - arrival)
+            with self._condition:
+                self.batches += 1
+                self.processed += len(items)
+                self.busy_time += elapsed
+                self.cpu_time += cpu
+                self.wait_time += sum(start - arrival for _, _, arrival in batch)
+            for (ticket, _, _), result in zip(batch, results):
+                self._finish(ticket, result)
+
+    def _finish(self, ticket, result):
+        """
+        Record the result of a ticket and forward every result of its key that is next in order.
+        The results are forwarded after the lock is released, since next_stage.put() may block on a full
+        queue; one worker forwards at a time, in order, while the others only add to the outbox. A full
+        outbox holds the other workers back, so a slow next stage still fills this stage's queue.
+        """
+        key = ticket[0]
+        with self._emit_lock:
+            self._finished[ticket] = result
+            number = self._emit_ticket.get(key, 0)
+            while (key, number) in self._finished:
+                result = self._finished.pop((key, number))
+                number += 1
+                if result is not None and self.next_stage is not None:
+                    self._outbox.append(result)
+            self._emit_ticket[key] = number
+            if self._forwarding:
+                while self._forwarding and len(self._outbox) >= self.queue_size and not self._stopped:
+                    self._emit_lock.wait(0.1)
+                return
+            self._forwarding = True
+        while True:
+            with self._emit_lock:
+                if not self._outbox:
+                    self._forwarding = False
+                    return
+                result = self._outbox.popleft()
+                self._emit_lock.notify_all()
+            self.next_stage.put(result)
+
+    def stats(self):
+        """
+        :return: Dict with the queue depth, processed / dropped counts and mean times (ms) of the stage.
+        """
+        with self._condition:
+            processed = max(self.processed, 1)
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "depth": len(self._items),
+                "max_depth": self.max_depth,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "mean_batch": self.processed / max(self.batches, 1),
+                "service_ms": 1000 * self.busy_time / max(self.batches, 1),
+                "wait_ms": 1000 * self.wait_time / processed,
+                "cpu_s": self.cpu_time,
+            }
+
+
+class Pipeline:
+    """
+    Chain of stages, each one feeding its results to the next.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next_stage = next_stage
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+        return self
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def submit(self, item, timeout=None):
+        """
+        Queue an item into the first stage.
+        :return: False if it was not accepted (see Stage.put).
+        """
+        return self.stages[0].put(item, timeout)
+
+    def stats(self):
+        return [stage.stats() for stage in self.stages]
+
+    def report(self):
+        """
+        :return: One line per stage with its queue depth and timings.
+        """
+        return "\n".join(
+            f"{s['stage']:>12}: depth {s['depth']:>3} (max {s['max_depth']:>3}), processed {s['processed']:>7}, "
+            f"dropped {s['dropped']:>5}, batch {s['mean_batch']:.2f}, service {s['service_ms']:.2f} ms, "
+            f"wait {s['wait_ms']:.2f} ms, cpu {s['cpu_s']:.2f} s"
+            for s in self.stats()
+        )
@@ -1,113 +1,286 @@
+import logging
+import time
 import cv2
 import numpy as np
 import deepvog
-import tensorflow as tf
-from server_side.send_pupil_information import send_info
+from server_side.roi import RoiTracker, scale_ellipse, window_confidence, paste_window_mask
+from deepvog.ellipse_fit import fit_ellipses
+from server_side.buffers import BatchBufferPool, ScratchBuffers, preprocess_into
+from server_side.frame_codec import decode_stats
 
-# # Print environment variables
-# print("CUDA Path:", os.environ.get('PATH'))
-# print("CUDA Library Path:", os.environ.get('LD_LIBRARY_PATH'))
-#
-# Check GPU availability
-print("Num GPUs Available: ", len(tf.config.list_physical_devices('GPU')))
-print("GPUs:", tf.config.list_physical_devices('GPU'))
+# TensorFlow is not imported here: deepvog imports it only for the backends that run on it (keras, tflite,
+# int8), so the server starts without it with onnx or stub
 
-# # Print CUDA driver version
-# print(tf.sysconfig.get_build_info())
+logger = logging.getLogger(__name__)
 
 # Global model variable to ensure it is loaded only once
 model = None
+# Number of input channels of the loaded model: 3 (BGR) or 1 (grayscale variant)
+input_channels = 3
+# Region-of-interest tracking (see enable_roi_tracking), None segments every frame full-frame
+roi_model = None
+roi_tracker = None
+# Reusable float32 input batches, frames are preprocessed straight into them
+batch_pool = BatchBufferPool()
 
 
-def load_model_once():
+def load_model_once(backend="keras", **options):
     """
     Load the deep learning model only once and cache it globally.
+    :param backend: Inference backend name ('keras', 'onnx', 'tflite' or 'int8').
+    :param options: Backend options such as model_path, num_threads or channels (1 for grayscale end to end).
     """
-    global model
+    global model, input_channels
     if model is None:
-        print("Loading model...")
-        with tf.device('/GPU:0'):  # Load model on GPU
-            model = deepvog.load_DeepVOG()
-        print("Model loaded successfully.")
+        if backend == "keras":
+            # Check GPU availability, once at startup
+            import tensorflow as tf
+            logger.info(f"GPUs available: {tf.config.list_physical_devices('GPU')}")
+        logger.info(f"Loading model ({backend} backend)...")
+        start = time.perf_counter()
+        model = deepvog.load_backend(backend, **options)
+        input_channels = options.get("channels", 3)
+        logger.info(f"Model loaded successfully in {time.perf_counter() - start:.2f} s.")
     else:
-        print("Model already loaded.")
+        logger.debug("Model already loaded.")
+
+
+def enable_roi_tracking(backend="keras", window_size=(128, 128), min_confidence=0.6, **options):
+    """
+    Segment tracked eyes inside a native-resolution window around their last ellipse.
+    Loads a second model built for `window_size` with the same backend options as the full-frame model.
+    :param window_size: (height, width) of the window, multiples of 16.
+    :param min_confidence: Below this confidence an eye falls back to full-frame inference.
+    """
+    global roi_model, roi_tracker
+    logger.info(f"Loading {window_size[0]}x{window_size[1]} ROI model ({backend} backend)...")
+    roi_model = deepvog.load_backend(backend, input_size=tuple(window_size), **options)
+    roi_tracker = RoiTracker(window_size, min_confidence)
+
+
+def warmup(batch_sizes=(1, 2, 16), target_size=(240, 320), source_size=(192, 192)):
+    """
+    Run synthetic eye frames through the loaded model(s) before the first real frame arrives: the graph is
+    traced (or the interpreter tensors allocated) for these batch sizes and the batch buffer pool is filled,
+    so the first frames of a session do not pay for it.
+    :param batch_sizes: Batch sizes to run; include 1 and the largest batch the server builds.
+    :param source_size: (width, height) of the synthetic frames, the size of the Pupil eye cameras.
+    :return: Seconds spent.
+    """
+    start = time.perf_counter()
+    # Dark pupil on a mid-gray iris, so the ellipse fit runs as well
+    frame = np.full((source_size[1], source_size[0]), 120, dtype=np.uint8)
+    cv2.ellipse(frame, (source_size[0] // 2, source_size[1] // 2), (source_size[0] // 8, source_size[1] // 10),
+                0, 0, 360, 20, -1)
+    if input_channels == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+    for batch_size in batch_sizes:
+        masks, probabilities = predict_frames(model, [frame] * batch_size, target_size)
+        fit_ellipses(masks, probabilities)
+        if roi_model is not None:
+            window_h, window_w = roi_tracker.window_size
+            predict_frames(roi_model, [frame[:window_h, :window_w]] * batch_size, (window_h, window_w))
+    return time.perf_counter() - start
 
 
 def preprocess_input(image, target_size=(240, 320)):
     """
     Preprocess the input image to the required dimensions and normalize.
+    With a grayscale model, single-channel input is kept single-channel (H, W, 1).
+    The server itself uses the allocation-free predict_frames(), this returns a new array.
     """
+    if input_channels == 1 and image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    elif input_channels == 3 and image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
     image_resized = cv2.resize(image, (target_size[1], target_size[0]), interpolation=cv2.INTER_AREA)
     image_normalized = image_resized / 255.0  # Normalize to [0, 1]
+    if input_channels == 1:
+        image_normalized = image_normalized[..., np.newaxis]
     return image_normalized
 
 
+def predict(model, batch_images):
+    """
+    Run one batch of preprocessed images through the inference backend in a single call.
+    :return: (masks, probabilities): uint8 pupil masks (N, H, W) with values 0/255, and the float
+             pupil probability (N, H, W) when the model provides it, else None.
+    """
+    outputs = model.infer(batch_images)
+    if isinstance(outputs, tuple):  # Mask head with probability
+        masks, probabilities = outputs
+        return masks[..., 0], probabilities[..., 0]
+    if outputs.dtype == np.uint8:  # Mask head, the mask is computed in the graph
+        return outputs[..., 0], None
+
+    # Softmax head: take the class with the highest probability
+    predicted_class = np.argmax(outputs, axis=-1)
+    return (predicted_class * 255).astype(np.uint8), outputs[..., 1]
+
+
+def predict_frames(model, frames, target_size=(240, 320)):
+    """
+    Preprocess frames into a pooled float32 batch buffer and run them through the backend in one call.
+    :param frames: Native uint8 frames, BGR or single-channel.
+    :return: Same as predict().
+    """
+    buffer = batch_pool.acquire(len(frames), tuple(target_size) + (input_channels,))
+    try:
+        for frame, slot in zip(frames, buffer):
+            preprocess_into(frame, slot)
+        return predict(model, buffer[:len(frames)])
+    finally:
+        batch_pool.release(buffer)
+
+
+def allocation_stats():
+    """
+    Allocation counters of the preprocessing stage; constant values mean the steady state allocates nothing.
+    """
+    return {
+        "batch_buffers_allocated": batch_pool.allocations,
+        "batch_buffers_acquired": batch_pool.acquires,
+        "scratch_buffers_allocated": ScratchBuffers.allocations,
+        "frames_decoded": decode_stats["frames"],
+        "decoded_frames_allocated": decode_stats["allocated"],
+    }
+
+
+def fit_pupil_ellipse(mask):
+    """
+    Fit the pupil ellipse on a uint8 mask (see ellipse_fit.fit_ellipses for batches).
+    :return: OpenCV ellipse ((cx, cy), (width, height), angle) in mask pixels, or None if no pupil was found.
+    """
+    ellipses, _ = fit_ellipses(mask)
+    return ellipses[0]
+
+
+def postprocess_pair(masks, ids, frameID, ellipses=None, confidences=None, source_sizes=None):
+    """
+    Send the pupil ellipses of one frame pair.
+    :param masks: uint8 pupil masks (0/255) for the frames, in the same order.
+    :param ids: List of IDs corresponding to the frames (e.g., left or right eye).
+    :param frameID: Global frame identifier for both eyes.
+    :param ellipses: Ellipses already fitted in target_size coordinates, fitted on the masks if None.
+    :param confidences: Confidence of each ellipse, computed with them if ellipses is None.
+    :param source_sizes: (width, height) of each input frame, in the same order; the ellipses are sent in
+                         those pixel coordinates.
+    :return: The ellipse per eye, in target_size coordinates.
+    """
+    if ellipses is None:
+        ellipses, confidences = fit_ellipses(masks)
+    pupil_info = [None, None]
+    pupil_confidence = [0.0, 0.0]
+    pupil_source_sizes = None if source_sizes is None else [None, None]
+    for i, (id, ellipse, confidence) in enumerate(zip(ids, ellipses, confidences)):  # Left or right eye identifier
+        pupil_info[id] = ellipse
+        pupil_confidence[id] = float(confidence)
+        if source_sizes is not None:
+            pupil_source_sizes[id] = source_sizes[i]
+
+    logger.debug(f"Pupil info: {pupil_info}")
+    # Imported here: it binds the result socket, which model replicas and the offline mode must not do
+    from server_side.send_pupil_information import send_info
+    send_info(pupil_info, frameID, pupil_confidence, pupil_source_sizes)  # Include frameID in the sent information
+    return pupil_info
+
+
 def process_batch(model, frames, ids, frameID):
     """
-    Process a batch of frames, predict using the model, and draw contours on each frame.
-    :param model: The deep learning model.
+    Process a batch of frames, predict using the model, and send the pupil ellipses.
+    Nothing is drawn here, see preview.render_pair for the visualization.
+    :param model: The inference backend (see deepvog.load_backend).
     :param frames: List of input frames (NumPy arrays).
     :param ids: List of IDs corresponding to the frames (e.g., left or right eye).
     :param frameID: Global frame identifier for both eyes.
-    :return: Combined visualization of processed frames.
+    :return: The ellipse per eye, in 240x320 coordinates.
     """
-    # Preprocess all frames
+    # Preprocess all frames into a single batch and predict
     target_size = (240, 320)  # Target size for preprocessing
-    preprocessed_frames = [preprocess_input(frame, target_size) for frame in frames]
-    batch_images = np.array(preprocessed_frames)  # Combine into a single batch
-    pupil_info = [None, None]
+    masks, ellipses, confidences = segment_frames(model, frames, ids, target_size)
+    source_sizes = [(frame.shape[1], frame.shape[0]) for frame in frames]
+    return postprocess_pair(masks, ids, frameID, ellipses, confidences, source_sizes)
+
+
+def process_pairs(model, pairs):
+    """
+    Process several frame pairs with a single model call.
+    :param model: The inference backend (see deepvog.load_backend).
+    :param pairs: List of (frame0, frame1, frameID) tuples, possibly from different streams.
+    :return: List with the pupil_info of each pair, in input order.
+    """
+    target_size = (240, 320)  # Target size for preprocessing
+    frame_ids = [0, 1]  # 0 for left eye, 1 for right eye
+    # Frames are laid out as [pair0_left, pair0_right, pair1_left, ...]
+    frames = [frame for frame0, frame1, _ in pairs for frame in (frame0, frame1)]
+    masks, ellipses, confidences = segment_frames(model, frames, frame_ids * len(pairs), target_size)
+
+    return [postprocess_pair(masks[2 * i:2 * i + 2], frame_ids, frameID,
+                             ellipses[2 * i:2 * i + 2], confidences[2 * i:2 * i + 2],
+                             [(frame.shape[1], frame.shape[0]) for frame in (frame0, frame1)])
+            for i, (frame0, frame1, frameID) in enumerate(pairs)]
+
+
+def segment_frames(model, frames, eyes, target_size=(240, 320)):
+    """
+    Segment frames with a single model call (two with ROI tracking) and fit their pupil ellipses as one batch.
+    :param frames: List of native input frames.
+    :param eyes: Eye identifier of each frame, used by ROI tracking.
+    :return: (masks, ellipses, confidences): target_size masks, ellipses in target_size coordinates
+             (None where no pupil was found) and their confidence, per frame.
+    """
+    if roi_tracker is not None:
+        return segment_tracked(model, frames, eyes, target_size)
+    masks, probabilities = predict_frames(model, frames, target_size)
+    ellipses, confidences = fit_ellipses(masks, probabilities)
+    return masks, ellipses, confidences
+
+
+def segment_tracked(model, frames, eyes, target_size=(240, 320)):
+    """
+    Segment frames with ROI tracking. Tracked eyes run through roi_model on a native-resolution window
+    around their last ellipse, the others run full-frame through the model.
+    :param frames: List of native input frames.
+    :param eyes: Tracker key (eye identifier) of each frame.
+    :return: (masks, ellipses, confidences): target_size masks, ellipses in target_size coordinates and
+             their confidence, per frame.
+    """
+    origins = [roi_tracker.window(eye, frame.shape) for frame, eye in zip(frames, eyes)]
+    full_indices = [i for i, origin in enumerate(origins) if origin is None]
+    window_indices = [i for i, origin in enumerate(origins) if origin is not None]
+    masks = [None] * len(frames)
+    ellipses = [None] * len(frames)
+    confidences = np.zeros(len(frames), dtype=np.float32)
+
+    if full_indices:
+        full_masks, probabilities = predict_frames(model, [frames[i] for i in full_indices], target_size)
+        full_ellipses, full_confidences = fit_ellipses(full_masks, probabilities)
+        for i, mask, ellipse, confidence in zip(full_indices, full_masks, full_ellipses, full_confidences):
+            frame_h, frame_w = frames[i].shape[:2]
+            masks[i] = mask
+            ellipses[i] = ellipse
+            confidences[i] = confidence
+            native = None
+            if ellipse is not None:
+                native = scale_ellipse(ellipse, frame_w / target_size[1], frame_h / target_size[0])
+            roi_tracker.update(eyes[i], native, confidence)
+
+    if window_indices:
+        window_h, window_w = roi_tracker.window_size
+        crops = [frames[i][origins[i][1]:origins[i][1] + window_h, origins[i][0]:origins[i][0] + window_w]
+                 for i in window_indices]
+        window_masks, probabilities = predict_frames(roi_model, crops, (window_h, window_w))
+        window_ellipses, window_confidences = fit_ellipses(window_masks, probabilities)
+        for i, mask, ellipse, confidence in zip(window_indices, window_masks, window_ellipses, window_confidences):
+            frame_h, frame_w = frames[i].shape[:2]
+            scale_x, scale_y = target_size[1] / frame_w, target_size[0] / frame_h
+            native = None if ellipse is None else scale_ellipse(ellipse, 1, 1, origins[i])
+            confidences[i] = window_confidence(mask, confidence)
+            roi_tracker.update(eyes[i], native, confidences[i])
+            ellipses[i] = None if native is None else scale_ellipse(native, scale_x, scale_y)
+            masks[i] = paste_window_mask(mask, origins[i], scale_x, scale_y, target_size)
 
-    # print(f"Processing batch with shape: {batch_images.shape}")  # Debug batch shape
-
-    with tf.device('/GPU:0'):  # Predict on GPU
-        predictions = model.predict(batch_images, batch_size=2)  # Batch prediction
-
-    # Process predictions for each frame
-    combined_images = []
-    for idx, prediction in enumerate(predictions):
-        frame = frames[idx]
-        id = ids[idx]  # Left or right eye identifier
-
-        # Process prediction results
-        predicted_class = np.argmax(prediction, axis=-1)  # Get class with the highest probability
-        prediction_image = (predicted_class * 255).astype(np.uint8)  # Convert to grayscale image format
-
-        # Detect contours on the prediction
-        contours, _ = cv2.findContours(prediction_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        # Resize the original frame to match the target size
-        resized_frame = cv2.resize(frame, (target_size[1], target_size[0]), interpolation=cv2.INTER_AREA)
-
-        # Draw contours on the resized original frame
-        frame_with_contours = resized_frame.copy()  # Create a copy to draw on
-        for contour in contours:
-            if len(contour) >= 5:  # Ensure there are enough points to fit an ellipse
-                ellipse = cv2.fitEllipse(contour)
-                # Extract width and height from the ellipse parameters
-                (center, (width, height), angle) = ellipse
-                # Check if both dimensions are positive
-                if width > 0 and height > 0:
-                    cv2.ellipse(frame_with_contours, ellipse, (0, 255, 0), 2)  # Draw ellipse in green
-                    pupil_info[id] = ellipse
-                else:
-                    print("Skipped drawing ellipse with invalid dimensions:", ellipse)
-
-        # Convert prediction image to BGR for visualization
-        prediction_bgr = cv2.cvtColor(prediction_image, cv2.COLOR_GRAY2BGR)
-
-        # Combine resized original, prediction, and the frame with contours
-        combined_image = np.hstack((resized_frame, prediction_bgr, frame_with_contours))
-        combined_images.append(combined_image)
-
-    print(f"Pupil info: {pupil_info}")
-    # if pupil_info.__len__() < 1:
-    #     pupil_info.append(None)
-    #     pupil_info.append(None)
-    # elif pupil_info.__len__() == 1:
-    #     pupil_info.append(None)
-    # Combine all processed images horizontally for final visualization
-    send_info(pupil_info, frameID)  # Include frameID in the sent information
-    return np.vstack(combined_images)
+    return masks, ellipses, confidences
 
 
 def main(frame0, frame1, frameID):
@@ -118,9 +291,7 @@ def main(frame0, frame1, frameID):
     :param frameID: Global frame identifier for both eyes.
     """
     global model  # Use the global model variable
-    # Ensure GPU is visible
-    print(f"Processing Frame ID: {frameID}")
-    print("GPUs available:", tf.config.list_physical_devices('GPU'))
+    logger.debug(f"Processing Frame ID: {frameID}")
 
     # Load the model only once
     load_model_once()
@@ -128,7 +299,7 @@ def main(frame0, frame1, frameID):
     # Frame IDs for distinguishing left and right eye
     frame_ids = [0, 1]  # 0 for left eye, 1 for right eye
 
-    # Process the batch (frame0: left eye, frame1: right eye)
+    # Process the batch (frame0: left eye, frame1: right eye), returns the ellipse per eye
     processed_result = process_batch(model, [frame0, frame1], frame_ids, frameID)
 
     return processed_result
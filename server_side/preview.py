@@ -0,0 +1,99 @@
+import threading
+import time
+import cv2
+import numpy as np
+
+
+def render_pair(frames, masks, ellipses, target_size=(240, 320)):
+    """
+    Build the visualization of a frame pair: resized original, predicted mask and fitted ellipse side by side.
+    :param frames: List of original input frames (NumPy arrays).
+    :param masks: uint8 pupil masks (0/255) for the frames, in the same order.
+    :param ellipses: Ellipse per frame in target_size coordinates, or None.
+    :return: Combined visualization of processed frames.
+    """
+    combined_images = []
+    for frame, prediction_image, ellipse in zip(frames, masks, ellipses):
+        # Resize the original frame to match the target size
+        resized_frame = cv2.resize(frame, (target_size[1], target_size[0]), interpolation=cv2.INTER_AREA)
+        if resized_frame.ndim == 2:  # Grayscale decoding, draw in color
+            resized_frame = cv2.cvtColor(resized_frame, cv2.COLOR_GRAY2BGR)
+
+        # Draw the pupil ellipse on the resized original frame
+        frame_with_contours = resized_frame.copy()  # Create a copy to draw on
+        if ellipse is not None:
+            cv2.ellipse(frame_with_contours, ellipse, (0, 255, 0), 2)  # Draw ellipse in green
+
+        # Convert prediction image to BGR for visualization
+        prediction_bgr = cv2.cvtColor(prediction_image, cv2.COLOR_GRAY2BGR)
+
+        # Combine resized original, prediction, and the frame with contours
+        combined_image = np.hstack((resized_frame, prediction_bgr, frame_with_contours))
+        combined_images.append(combined_image)
+
+    # Combine all processed images vertically for final visualization
+    return np.vstack(combined_images)
+
+
+class Preview:
+    """
+    Optional, rate-limited consumer of the prediction results.
+    The prediction path only hands over references to the latest frames, masks and ellipses with
+    offer(); the visualization is rendered lazily by the display side, at most `rate` times per
+    second and only from the newest result. Results replaced before they were rendered cost nothing.
+    """
+
+    def __init__(self, rate=10.0, target_size=(240, 320)):
+        """
+        :param rate: Maximum rendered previews per second.
+        :param target_size: (height, width) the masks and ellipses refer to.
+        """
+        self.interval = 1.0 / rate
+        self.target_size = target_size
+        self._lock = threading.Lock()
+        self._latest = {}  # eye -> (frame, mask, ellipse)
+        self._generation = 0
+        self._rendered_generation = 0
+        self._last_render = 0.0
+        self._new_result = threading.Event()  # Set by offer(), cleared when the result is rendered
+        self.offered = 0
+        self.rendered = 0
+
+    def offer(self, frames, masks, ellipses, eyes=(0, 1)):
+        """
+        Replace the latest result of the given eyes. Cheap enough for the hot path: nothing is copied or drawn.
+        """
+        with self._lock:
+            for eye, frame, mask, ellipse in zip(eyes, frames, masks, ellipses):
+                self._latest[eye] = (frame, mask, ellipse)
+            self._generation += 1
+            self.offered += 1
+        self._new_result.set()
+
+    def wait(self, timeout=None):
+        """
+        Sleep until the next preview may be rendered, then until a new result is offered.
+        :param timeout: Maximum seconds to wait for a new result, defaults to the render interval, so the
+                        display loop still handles its window events while no result arrives.
+        :return: True if a new result is waiting to be rendered.
+        """
+        remaining = self._last_render + self.interval - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        return self._new_result.wait(self.interval if timeout is None else timeout)
+
+    def render(self):
+        """
+        :return: The visualization of the newest result not rendered yet, or None.
+        """
+        with self._lock:
+            if self._generation == self._rendered_generation:
+                return None
+            self._rendered_generation = self._generation
+            self._new_result.clear()
+            latest = [self._latest[eye] for eye in sorted(self._latest)]
+            self._latest = {}  # Do not keep the frames alive longer than needed
+        self._last_render = time.monotonic()
+        self.rendered += 1
+        frames, masks, ellipses = zip(*latest)
+        return render_pair(frames, masks, ellipses, self.target_size)
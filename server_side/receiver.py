@@ -1,145 +1,404 @@
+import argparse
+import logging
 import zmq
 import cv2
 import numpy as np
 import threading
-import prediction
-import queue
 import time
+import prediction
+from server_side.tracker import TemporalTrackerStage
+from server_side.frame_codec import parse_header, decode_frame, frame_source
+from server_side.pipeline import FrameJob, Stage, Pipeline
+from server_side.preview import Preview
+from server_side.metrics import metrics, serve_prometheus, write_csv_periodically
+from server_side.worker_pool import InferenceWorkerPool
+from server_side.streams import StreamRegistry, LOCAL_STREAM
+from server_side.result_cache import ResultCache
+
+# Start of the server; the startup time and the time to the first result are measured from here
+process_start = time.time()
+
+# Micro-batching: up to BATCH_MAX_MESSAGES frame messages (single eye frames or pairs) share one model call,
+# the oldest message waits at most BATCH_MAX_WAIT seconds for the batch to fill up
+BATCH_MAX_MESSAGES = 8
+BATCH_MAX_WAIT = 0.005
+# Bound of every stage queue; the decode queue drops its oldest messages when full
+STAGE_QUEUE_SIZE = 16
+TARGET_SIZE = (240, 320)
+
+parser = argparse.ArgumentParser(description="DeepVOG real-time inference server")
+parser.add_argument("--backend", default="keras", choices=["keras", "onnx", "tflite", "int8", "stub"],
+                    help="Inference backend, pick whichever is fastest on this host ('stub' runs no model, for benchmarks)")
+parser.add_argument("--model-path", default=None, help="ONNX / TFLite / INT8 model file (exported on first use if missing)")
+parser.add_argument("--threads", type=int, default=None, help="Intra-op threads used by the backend")
+parser.add_argument("--grayscale", action="store_true",
+                    help="Decode, preprocess and infer on a single channel with the folded 1-channel model")
+parser.add_argument("--mask-head", action="store_true",
+                    help="Compute the uint8 pupil mask inside the graph instead of returning the softmax")
+parser.add_argument("--roi-size", default=None, metavar="HxW",
+                    help="Track the pupil and segment a native-resolution HxW window (multiples of 16, e.g. 128x128) "
+                         "around the last ellipse instead of the whole frame")
+parser.add_argument("--temporal-tracking", action="store_true",
+                    help="Track pupils with Kalman + optical flow and only run the CNN every few frames")
+parser.add_argument("--max-skip", type=int, default=8,
+                    help="Upper bound on the frames tracked between two CNN runs with --temporal-tracking")
+parser.add_argument("--listen", default=None, metavar="ADDRESS",
+                    help="Also serve many clients (headsets) on this ROUTER endpoint, e.g. tcp://*:5556; every "
+                         "client gets its own stream and its results are sent back to it")
+parser.add_argument("--result-cache", type=int, default=32, metavar="N",
+                    help="Answer repeated frames from a per-stream LRU cache of the last N messages, keyed by the "
+                         "encoded frame bytes, without decoding or inference (0: disabled)")
+parser.add_argument("--decode-workers", type=int, default=2, help="Threads decoding incoming frames")
+parser.add_argument("--inference-workers", type=int, default=0,
+                    help="Model replicas in separate processes, each pinned to its own share of the CPU cores "
+                         "(--threads sets the threads per replica); 0 runs the model in this process")
+parser.add_argument("--headless", action="store_true",
+                    help="Do not open the preview window; nothing is rendered on the prediction path")
+parser.add_argument("--preview-rate", type=float, default=10.0,
+                    help="Maximum preview frames rendered per second, from the latest result")
+parser.add_argument("--stats-interval", type=float, default=0,
+                    help="Log the queue depth and service time of every stage every N seconds (0: at exit only)")
+parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                    help="Log verbosity; per-frame messages (pupil info, lost frames) are logged at DEBUG")
+parser.add_argument("--metrics-port", type=int, default=0,
+                    help="Serve latency histograms and counters in the Prometheus text format on "
+                         "http://127.0.0.1:PORT/metrics (0: disabled)")
+parser.add_argument("--metrics-csv", default=None, help="Append a metrics snapshot to this CSV file periodically")
+parser.add_argument("--metrics-interval", type=float, default=10.0, help="Seconds between two CSV snapshots")
+logger = logging.getLogger("receiver")
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.mask_head and args.backend == "int8":
+        parser.error("--mask-head is not available for the int8 backend")
+    if args.inference_workers and args.roi_size:
+        parser.error("--roi-size needs the native frames and is not available with --inference-workers")
+
+    # Latest result for the display thread, rendered lazily at a capped rate (None when headless)
+    preview = None if args.headless else Preview(args.preview_rate, TARGET_SIZE)
+
+    # ---------------------- Load Model ----------------------
+    backend_options = {"num_threads": args.threads, "channels": 1 if args.grayscale else 3}
+    if args.mask_head:
+        backend_options["head"] = "mask"
+    if args.model_path and args.backend != "keras":
+        backend_options["model_path"] = args.model_path
+    worker_pool = None
+    if args.inference_workers:
+        # Every message holds at most two frames
+        worker_pool = InferenceWorkerPool(args.inference_workers, args.backend, backend_options, 2 * BATCH_MAX_MESSAGES,
+                                          TARGET_SIZE, args.threads, return_masks=preview is not None).start()
+    else:
+        prediction.load_model_once(args.backend, **backend_options)
+    if args.roi_size:
+        roi_options = dict(backend_options)
+        roi_options.pop("model_path", None)  # The window model is exported for its own input size
+        prediction.enable_roi_tracking(args.backend, tuple(int(v) for v in args.roi_size.lower().split("x")),
+                                       **roi_options)
+    if worker_pool is None:
+        # Trace the model for single messages and for full micro-batches before the first frame arrives
+        logger.info(f"Warmup done in {prediction.warmup((1, 2, 2 * BATCH_MAX_MESSAGES), TARGET_SIZE):.2f} s.")
+
+    # The sockets are opened once the model is warm, so no frame queues up behind the model load.
+    # Importing send_pupil_information binds the result socket.
+    from server_side.send_pupil_information import encode_info, publish
+
+    # ZeroMQ Context and Socket
+    context = zmq.Context()
+    socket = context.socket(zmq.PULL)
+    socket.connect("tcp://localhost:5555")
+
+    # Poller setup
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+
+    # Multi-headset endpoint: clients connect DEALER sockets (sender.connect) and get their results back on them
+    streams = StreamRegistry()
+    router = None
+    routed_results_in = None
+    routed_results = None
+    if args.listen:
+        router = context.socket(zmq.ROUTER)
+        router.bind(args.listen)
+        poller.register(router, zmq.POLLIN)
+        # The ROUTER socket belongs to the receiver thread: the publish stage hands it the results over inproc
+        routed_results_in = context.socket(zmq.PULL)
+        routed_results_in.bind("inproc://routed-results")
+        poller.register(routed_results_in, zmq.POLLIN)
+        routed_results = context.socket(zmq.PUSH)
+        routed_results.connect("inproc://routed-results")
+
+    display_stop = threading.Event()
+    receiver_stop = threading.Event()
+    first_result = threading.Event()
+
+    # ---------------------- Frame Receiver Thread ----------------------
+    def accept_message(parts, stream):
+        # Only the header is parsed here, the frames are decoded by the decode stage
+        header = parse_header(parts[0])
+        attent_id = header["attent_id"]
+
+        # Handle missing messages, attent_id numbers the messages of a stream whether they carry one eye or a pair
+        metrics.inc("frames_received", len(parts) - 1)
+        metrics.inc("messages_received")
+        lost = streams.lost_messages(stream, attent_id)
+        if lost:
+            logger.debug(f"Lost {lost} messages of stream {stream} before {attent_id}.")
+            metrics.inc("messages_lost", lost)
+
+        # Hand the message to the pipeline; the decode stage drops the oldest message of the stream when it is full
+        pipeline.submit(FrameJob(attent_id, header, parts, stream))
+
+    def receive_frames_thread():
+        logger.info("Starting frame receiver thread...")
+        while not receiver_stop.is_set():
+            try:
+                # Poll for incoming messages with a timeout
 
-# ZeroMQ Context and Socket
-context = zmq.Context()
-socket = context.socket(zmq.PULL)
-socket.connect("tcp://localhost:5555")
-
-# Poller setup
-poller = zmq.Poller()
-poller.register(socket, zmq.POLLIN)
-
-attent_id = 0
-last_attent_id = -1
-received_frame0 = None
-received_frame1 = None
-lock = threading.Lock()
-
-# Queue for passing frames to the display thread
-display_queue = queue.Queue(maxsize=10)
-
-
-# ---------------------- Frame Receiver Thread ----------------------
-def receive_frames_thread():
-    global received_frame0, received_frame1, last_attent_id, attent_id
-    print("Starting frame receiver thread...")
-    while True:
-        try:
-            # Poll for incoming messages with a timeout
-
-            events = dict(poller.poll(100))  # 100ms timeout to avoid infinite waiting
-            if socket in events and events[socket] == zmq.POLLIN:
-                # Receive multipart message
-                parts = socket.recv_multipart()
-
-                # Decode attent_id
-                attent_id = int(parts[0].decode())  # Decode the first part (attent_id)
-
-                # Decode frames from bytes
-                frame0_bytes = parts[1]
-                frame1_bytes = parts[2]
-                frame0 = cv2.imdecode(np.frombuffer(frame0_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
-                frame1 = cv2.imdecode(np.frombuffer(frame1_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
-
-                # Handle missing frames
-                if last_attent_id != -1 and attent_id != last_attent_id + 1:
-                    print(f"Warning: Lost frames! Expected {last_attent_id + 1}, but got {attent_id}.")
-                last_attent_id = attent_id
-
-                # Update the received frame (use frame0 or frame1 as needed)
-                with lock:
-                    received_frame0 = frame0
-                    received_frame1 = frame1
-
-        except Exception as e:
-            print(f"Error in receiver thread: {e}")
-            break
-
-
-# ---------------------- Display Thread ----------------------
-def display_frames_thread():
-    """
-    Continuously display frames without blocking the main processing.
-    """
-    print("Starting display thread...")
-    while True:
-        try:
-            frame = display_queue.get()
-            if frame is None:  # Exit condition
+                events = dict(poller.poll(100))  # 100ms timeout to avoid infinite waiting
+                if socket in events and events[socket] == zmq.POLLIN:
+                    # Receive multipart message from the local client
+                    accept_message(socket.recv_multipart(), LOCAL_STREAM)
+
+                if router is not None and router in events:
+                    identity, *parts = router.recv_multipart()
+                    accept_message(parts, streams.stream_id(identity))
+
+                if router is not None and routed_results_in in events:
+                    stream, message = routed_results_in.recv_multipart()
+                    identity = streams.identity(int.from_bytes(stream, "little"))
+                    try:
+                        # Results for a client that is gone or too slow to read them are dropped
+                        router.send_multipart([identity, message], zmq.NOBLOCK)
+                    except zmq.Again:
+                        metrics.inc("results_dropped")
+
+            except Exception as e:
+                logger.error(f"Error in receiver thread: {e}")
                 break
+        # The sockets belong to this thread, they must be closed before the context can terminate
+        for receiving_socket in (socket, router, routed_results_in):
+            if receiving_socket is not None:
+                receiving_socket.close(linger=0)
 
-            cv2.imshow("Processed Frame", frame)
+    # ---------------------- Display Thread ----------------------
+    def display_frames_thread():
+        """
+        Render and display the latest result at most --preview-rate times per second, without blocking the main
+        processing.
+        """
+        logger.info("Starting display thread...")
+        while not display_stop.is_set():
+            try:
+                preview.wait()
+                frame = preview.render()
+                if frame is not None:
+                    cv2.imshow("Processed Frame", frame)
 
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                print("Exiting display thread.")
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    logger.info("Exiting display thread.")
+                    break
+            except Exception as e:
+                logger.error(f"Error in display thread: {e}")
                 break
-        except queue.Empty:
-            continue
-        except Exception as e:
-            print(f"Error in display thread: {e}")
-            break
-    cv2.destroyAllWindows()
-
-
-# ---------------------- Main Processing Thread ----------------------
-def process_frames_thread():
-    """
-    Processes frames and adds them to the display queue.
-    """
-    print("Starting processing thread...")
-    while True:
-        try:
-            with (lock):
-                if (
-                    received_frame0 is not None and
-                    received_frame1 is not None
-                ):
-                    frame_copy0 = received_frame0.copy()
-                    frame_copy1 = received_frame1.copy()
-                else:
-                    continue  # Skip if no frame is available
-
-            # Process the frame using prediction.main()
-            predicted_frame = prediction.main(frame_copy0, frame_copy1, attent_id)
-
-            # Add the processed frame to the display queue
-            if not display_queue.full():
-                display_queue.put(predicted_frame)
+        cv2.destroyAllWindows()
+
+    # ---------------------- Pipeline Stages ----------------------
+    result_cache = ResultCache(args.result_cache) if args.result_cache > 0 else None
+    tracker_stages = {}  # Temporal tracker of every stream, with --temporal-tracking
+
+    def tracker_stage_for(stream):
+        tracker_stage = tracker_stages.get(stream)
+        if tracker_stage is None:
+            tracker_stage = tracker_stages.setdefault(stream, TemporalTrackerStage(max_skip=args.max_skip))
+        return tracker_stage
+
+    def decode_stage(job):
+        """
+        Decode the frames of a message (a single eye frame or a pair) with the codec the client chose.
+        Eye cameras are infrared, so the color channels carry the same image.
+        Messages whose encoded frames are in the result cache are answered from it and not decoded.
+        """
+        if result_cache is not None:
+            job.cache_key = result_cache.key(job.header, job.parts[1:])
+            cached = result_cache.lookup(job.stream, job.cache_key)
+            if cached is not None:
+                job.pupil_info, job.confidences = cached.pupil_info, cached.confidences
+                job.source_sizes = cached.source_sizes
+                job.cached = True
+                job.parts = None
+                return job
+        job.frames = [decode_frame(frame_bytes, job.header["codec"], description, args.grayscale)
+                      for frame_bytes, description in zip(job.parts[1:], job.header["frames"])]
+        job.parts = None  # The cache key keeps the encoded frames for the result cache
+        return job
+
+    def track_stage(job):
+        """
+        Between CNN runs the trackers answer directly and the message skips inference.
+        """
+        if job.cached:
+            return job
+        eyes = job.header["eyes"]
+        tracker_stage = tracker_stage_for(job.stream)
+        tracked_info = tracker_stage.step(job.frames, job.attent_id, eyes)
+        if tracked_info is not None:
+            job.pupil_info = tracked_info
+            job.confidences = [tracker_stage.trackers[eye].confidence for eye in eyes]
+            job.tracked = True
+        return job
+
+    def infer_stage(jobs):
+        """
+        Segment a batch of messages, frames of either eye that arrived independently or pairs, from any stream,
+        with a single model call, and fit their pupil ellipses as one batch. Every frame keeps its own eye id and
+        timestamp, so frames are batched as they come instead of waiting for the other eye.
+        """
+        segmented = [job for job in jobs if not (job.tracked or job.cached)]
+        if segmented:
+            frames = [frame for job in segmented for frame in job.frames]
+            # ROI tracking state is kept per (stream, eye)
+            eyes = [(job.stream, eye) for job in segmented for eye in job.header["eyes"]]
+            if worker_pool is not None:
+                masks, ellipses, confidences = worker_pool.segment_frames(frames, eyes)
             else:
-                print("Display queue is full. Dropping frame.")
-                time.sleep(0.01)  # Small delay to prevent CPU overuse
-        except Exception as e:
-            print(f"Error in processing thread: {e}")
-            break
-
-
-# ---------------------- Start Threads ----------------------
-receiver_thread = threading.Thread(target=receive_frames_thread, daemon=True)
-display_thread = threading.Thread(target=display_frames_thread, daemon=True)
-processing_thread = threading.Thread(target=process_frames_thread, daemon=True)
-
-print("Starting all threads...")
-receiver_thread.start()
-processing_thread.start()
-display_thread.start()
-
-# ---------------------- Main Loop ----------------------
-try:
-    while True:
-        time.sleep(0.1)  # Prevent busy waiting in the main thread
-except KeyboardInterrupt:
-    print("Interrupted by user.")
-finally:
-    print("Terminating threads and context...")
-    display_queue.put(None)  # Signal the display thread to stop
-    receiver_thread.join(timeout=1)
-    processing_thread.join(timeout=1)
-    display_thread.join(timeout=1)
-    context.term()
-    print("All threads terminated.")
+                masks, ellipses, confidences = prediction.segment_frames(prediction.model, frames, eyes, TARGET_SIZE)
+            start = 0
+            for job in segmented:
+                end = start + len(job.frames)
+                job.masks = masks[start:end]
+                job.pupil_info = ellipses[start:end]  # In the order of job.header["eyes"]
+                job.confidences = [float(confidence) for confidence in confidences[start:end]]
+                start = end
+        return jobs
+
+    def publish_stage(job):
+        """
+        Send the pupil information in attent_id order, in source-camera pixels, to the stream it came from, and
+        offer the result to the preview.
+        """
+        eyes = job.header["eyes"]
+        if job.cached:
+            # Same encoded frames as the cached message, but the timestamps are this message's
+            sizes = job.source_sizes
+            timestamps = [None if description is None else description.get("timestamp")
+                          for description in job.header["frames"]]
+        else:
+            sources = [frame_source(frame, description)
+                       for frame, description in zip(job.frames, job.header["frames"])]
+            sizes = [size for size, _ in sources]
+            timestamps = [timestamp for _, timestamp in sources]
+        message = encode_info(job.pupil_info, job.attent_id, job.confidences, sizes, timestamps, job.stream,
+                              TARGET_SIZE, eyes)
+        if job.stream == LOCAL_STREAM:
+            publish(message)
+        else:
+            routed_results.send_multipart([job.stream.to_bytes(2, "little"), message])
+        metrics.observe("server_latency", time.perf_counter() - job.received)
+        if "capture_time" in job.header:  # Wall clock of the capture, set by the client
+            metrics.observe("end_to_end_latency", time.time() - job.header["capture_time"])
+        metrics.inc("frames_published", path="cache" if job.cached else "tracker" if job.tracked else "cnn")
+        if not first_result.is_set():
+            first_result.set()
+            metrics.observe("time_to_first_result", time.time() - process_start)
+            logger.info(f"First result published {time.time() - process_start:.2f} s after start.")
+        if job.tracked or job.cached:
+            return None
+        logger.debug(f"Pupil info: {job.pupil_info}")
+        if result_cache is not None:
+            result_cache.store(job.stream, job.cache_key, job.pupil_info, job.confidences, sizes)
+        if args.temporal_tracking:
+            tracker_stage_for(job.stream).on_cnn_result(job.attent_id, job.pupil_info, eyes)
+
+        # The preview keeps a reference to the latest result only, rendering happens in the display thread
+        if preview is not None:
+            preview.offer(job.frames, job.masks, job.pupil_info, [(job.stream, eye) for eye in eyes])
+        return None
+
+    # The decode stage queues and drops messages per stream and serves the streams round robin
+    stages = [Stage("decode", decode_stage, workers=args.decode_workers, queue_size=STAGE_QUEUE_SIZE, drop_oldest=True,
+                    fair_key=lambda job: job.stream)]
+    if args.temporal_tracking:
+        stages.append(Stage("track", track_stage, queue_size=STAGE_QUEUE_SIZE))
+    stages += [
+        # One thread per model replica; the stage's reorder buffer keeps the results in attent_id order
+        Stage("infer", infer_stage, workers=max(args.inference_workers, 1), queue_size=STAGE_QUEUE_SIZE,
+              max_batch=BATCH_MAX_MESSAGES, max_wait=BATCH_MAX_WAIT),
+        Stage("publish", publish_stage, queue_size=STAGE_QUEUE_SIZE),
+    ]
+    pipeline = Pipeline(stages)
+
+    # ---------------------- Start Threads ----------------------
+    receiver_thread = threading.Thread(target=receive_frames_thread, daemon=True)
+    display_thread = None if preview is None else threading.Thread(target=display_frames_thread, daemon=True)
+
+    metrics_server = serve_prometheus(metrics, args.metrics_port) if args.metrics_port else None
+    metrics_stop = threading.Event()
+    metrics_thread = None
+    if args.metrics_csv:
+        metrics_thread = write_csv_periodically(metrics, args.metrics_csv, args.metrics_interval, metrics_stop)
+
+    logger.info("Starting all threads...")
+    pipeline.start()
+    receiver_thread.start()
+    if display_thread is not None:
+        display_thread.start()
+    metrics.observe("startup_time", time.time() - process_start)
+    logger.info(f"Ready to receive frames {time.time() - process_start:.2f} s after start.")
+
+    # ---------------------- Main Loop ----------------------
+    try:
+        last_report = time.time()
+        while True:
+            time.sleep(0.1)  # Prevent busy waiting in the main thread
+            if args.stats_interval and time.time() - last_report >= args.stats_interval:
+                logger.info("Pipeline stages:\n" + pipeline.report())
+                last_report = time.time()
+    except KeyboardInterrupt:
+        logger.info("Interrupted by user.")
+    finally:
+        logger.info("Terminating threads and context...")
+        receiver_stop.set()  # Stop receiving, the receiver thread closes its sockets
+        pipeline.stop()  # Release the stage workers
+        if worker_pool is not None:
+            logger.info(f"Inference workers: {worker_pool.stats()}")
+            worker_pool.close()
+        display_stop.set()  # Signal the display thread to stop
+        metrics_stop.set()  # Write the last CSV snapshot
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        logger.info("Pipeline stages:\n" + pipeline.report())
+        logger.info(f"Frames received: {metrics.counter('frames_received')} in {metrics.counter('messages_received')} "
+                    f"messages, messages lost: {metrics.counter('messages_lost')}")
+        for name in ("server_latency", "end_to_end_latency"):
+            summary = metrics.histogram(name).snapshot()
+            if summary["count"]:
+                logger.info(f"{name}: p50 {1000 * summary['p50']:.1f} ms, p95 {1000 * summary['p95']:.1f} ms, "
+                            f"p99 {1000 * summary['p99']:.1f} ms")
+        logger.info(f"Preprocessing allocations: {prediction.allocation_stats()}")
+        if result_cache is not None:
+            logger.info(f"Result cache: {metrics.counter('result_cache_hits')} hits, "
+                        f"{metrics.counter('result_cache_misses')} misses, "
+                        f"{metrics.counter('result_cache_evictions')} evictions")
+        if tracker_stages:
+            logger.info(f"Frame messages tracked: {sum(t.tracked_frames for t in tracker_stages.values())}, "
+                        f"segmented by the CNN: {sum(t.cnn_frames for t in tracker_stages.values())}")
+        if router is not None:
+            logger.info(f"Client streams served: {len(streams)}")
+        if preview is not None:
+            logger.info(f"Previews rendered: {preview.rendered} of {preview.offered} results")
+        receiver_thread.join(timeout=1)
+        if display_thread is not None:
+            display_thread.join(timeout=1)
+        if metrics_thread is not None:
+            metrics_thread.join(timeout=1)
+        if routed_results is not None:
+            routed_results.close(linger=0)
+        context.term()
+        logger.info("All threads terminated.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import os
+import zipfile
+import cv2
+import numpy as np
+
+# Per-frame result columns written by the offline mode, in file order
+RESULT_COLUMNS = {
+    "timestamp": np.float64,
+    "eye": np.uint8,
+    "frame_index": np.int64,
+    "center_x": np.float32,
+    "center_y": np.float32,
+    "axis_a": np.float32,
+    "axis_b": np.float32,
+    "angle": np.float32,
+    "confidence": np.float32,
+}
+
+
+def find_eye_videos(recording_dir):
+    """
+    Locate the eye videos of a Pupil recording folder and load their timestamps.
+    :return: List of (eye, video_path, timestamps) for every eye video that has a timestamp file.
+    """
+    videos = []
+    for eye in (0, 1):
+        timestamps_path = os.path.join(recording_dir, f"eye{eye}_timestamps.npy")
+        for extension in (".mp4", ".mjpeg", ".avi", ".mkv"):
+            video_path = os.path.join(recording_dir, f"eye{eye}{extension}")
+            if os.path.exists(video_path) and os.path.exists(timestamps_path):
+                videos.append((eye, video_path, np.load(timestamps_path)))
+                break
+    if not videos:
+        raise FileNotFoundError(f"No eye0/eye1 video with a timestamp file found in {recording_dir}")
+    return videos
+
+
+def video_frame_count(video_path):
+    capture = cv2.VideoCapture(video_path)
+    try:
+        return int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        capture.release()
+
+
+def decode_chunk(video_path, start, count, target_size=(240, 320), grayscale=False):
+    """
+    Decode `count` frames from frame `start` and shrink them to the network size.
+    Runs in the decode worker processes: only uint8 frames at the network resolution are sent back,
+    the float conversion happens in the inference process (prediction.predict_frames).
+    :param target_size: (height, width) the frames are resized to.
+    :return: (start, frames, source_size): uint8 frames (n, H, W[, 3]) with n <= count, and the
+             (width, height) of the source video.
+    """
+    capture = cv2.VideoCapture(video_path)
+    try:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        source_size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        shape = (count,) + tuple(target_size) + (() if grayscale else (3,))
+        frames = np.empty(shape, dtype=np.uint8)
+        decoded = 0
+        while decoded < count:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if grayscale:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            cv2.resize(frame, (target_size[1], target_size[0]), dst=frames[decoded], interpolation=cv2.INTER_AREA)
+            decoded += 1
+        return start, frames[:decoded], source_size
+    finally:
+        capture.release()
+
+
+class NpzColumnWriter:
+    """
+    Streams result chunks into a .npz file with one array per column, in bounded memory.
+    Every column is appended to a raw temporary file, and close() copies them into the archive
+    behind an .npy header, so the results of hour-long recordings are never held in memory.
+    """
+
+    def __init__(self, path, columns=RESULT_COLUMNS):
+        self.path = path
+        self.columns = dict(columns)
+        self.rows = 0
+        self._files = {name: open(f"{path}.{name}.tmp", "wb") for name in self.columns}
+
+    def write(self, chunk):
+        """
+        :param chunk: Dict of equally long 1-D arrays, one per column.
+        """
+        for name, dtype in self.columns.items():
+            np.asarray(chunk[name], dtype=dtype).tofile(self._files[name])
+        self.rows += len(chunk["timestamp"])
+
+    def close(self):
+        with zipfile.ZipFile(self.path, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for name, dtype in self.columns.items():
+                temporary = self._files[name]
+                temporary.close()
+                with archive.open(f"{name}.npy", "w", force_zip64=True) as entry, open(temporary.name, "rb") as raw:
+                    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False,
+                              "shape": (self.rows,)}
+                    np.lib.format.write_array_header_1_0(entry, header)
+                    while True:
+                        block = raw.read(1 << 20)
+                        if not block:
+                            break
+                        entry.write(block)
+                os.remove(temporary.name)
+
+
+class ParquetColumnWriter:
+    """
+    Streams result chunks into a Parquet file, one row group per chunk.
+    """
+
+    def __init__(self, path, columns=RESULT_COLUMNS):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing Parquet requires pyarrow: pip install pyarrow, or write a .npz file")
+        self._pa = pa
+        self.columns = dict(columns)
+        self.rows = 0
+        schema = pa.schema([(name, pa.from_numpy_dtype(np.dtype(dtype))) for name, dtype in self.columns.items()])
+        self._writer = pq.ParquetWriter(path, schema)
+
+    def write(self, chunk):
+        arrays = [self._pa.array(np.asarray(chunk[name], dtype=dtype)) for name, dtype in self.columns.items()]
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, names=list(self.columns)))
+        self.rows += len(chunk["timestamp"])
+
+    def close(self):
+        self._writer.close()
+
+
+def open_result_writer(path):
+    """
+    :return: A column writer for `path`, Parquet for *.parquet files and npz otherwise.
+    """
+    if path.endswith(".parquet"):
+        return ParquetColumnWriter(path)
+    return NpzColumnWriter(path)
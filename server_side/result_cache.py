@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict, namedtuple
+from server_side.metrics import metrics
+
+# Result of a segmented message: pupil_info and confidences per eye, and the source-camera size of each frame
+CachedResult = namedtuple("CachedResult", ["pupil_info", "confidences", "source_sizes"])
+
+
+class ResultCache:
+    """
+    Per-stream LRU cache of pupil results keyed by the encoded frame bytes of a message, checked before
+    the frames are decoded. A client that sends the same frame again (a camera that did not deliver a
+    new frame, a static test image) gets the cached ellipses back without decoding or inference.
+    Hits, misses and evictions are counted in the metrics registry (result_cache_*).
+    """
+
+    def __init__(self, capacity=32):
+        """
+        :param capacity: Messages kept per stream, the least recently used one is evicted first.
+        """
+        self.capacity = capacity
+        self._streams = {}  # stream -> OrderedDict(key -> CachedResult), least recently used first
+        self._lock = threading.Lock()
+
+    # Frame header fields that change how the same bytes are decoded or mapped back to the source camera
+    DESCRIPTION_FIELDS = ("width", "height", "channels", "source_width", "source_height")
+
+    @staticmethod
+    def key(header, frame_parts):
+        """
+        :return: Tuple of the codec, the eyes, the frame descriptions (raw shape, source size) and the encoded
+                 frames of a message. Python caches the hash of every bytes object, so the frames are hashed
+                 once whatever the number of lookups; a lookup compares the whole key, bytes included, so
+                 different frames sharing a hash never match.
+        """
+        descriptions = tuple(None if description is None else
+                             tuple(description.get(field) for field in ResultCache.DESCRIPTION_FIELDS)
+                             for description in header["frames"])
+        return (header["codec"], tuple(header["eyes"]), descriptions) + tuple(frame_parts)
+
+    def lookup(self, stream, key):
+        """
+        :return: The CachedResult of the same encoded frames, or None.
+        """
+        with self._lock:
+            entries = self._streams.get(stream)
+            entry = None if entries is None else entries.get(key)
+            if entry is not None:
+                entries.move_to_end(key)
+                metrics.inc("result_cache_hits")
+                return entry
+        metrics.inc("result_cache_misses")
+        return None
+
+    def store(self, stream, key, pupil_info, confidences, source_sizes):
+        with self._lock:
+            entries = self._streams.setdefault(stream, OrderedDict())
+            entries[key] = CachedResult(pupil_info, confidences, source_sizes)
+            entries.move_to_end(key)
+            while len(entries) > self.capacity:
+                entries.popitem(last=False)
+                metrics.inc("result_cache_evictions")
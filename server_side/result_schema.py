@@ -0,0 +1,68 @@
+"""
+Binary, versioned schema of the pupil result stream (server -> plugin / client).
+Shared by every producer and consumer; copy this file next to the Pupil Capture plugin.
+
+Message layout (little endian):
+    header  "<2sBBHQ"     magic b"DV", schema version, number of eye records, stream id, frame id
+    record  "<BB2xd6f"    eye id, flags (bit 0: ellipse present), capture timestamp (Pupil time, NaN if
+                          unknown), ellipse center x, center y, axis a, axis b, angle (degrees) in
+                          source-camera pixels, confidence in [0, 1]
+"""
+import math
+import struct
+from collections import namedtuple
+
+MAGIC = b"DV"
+SCHEMA_VERSION = 1
+_HEADER = struct.Struct("<2sBBHQ")
+_RECORD = struct.Struct("<BB2xd6f")
+_HAS_ELLIPSE = 0x01
+
+# Result of one eye: ellipse ((cx, cy), (axis_a, axis_b), angle) in source-camera pixels, or None
+EyeResult = namedtuple("EyeResult", ["eye", "timestamp", "ellipse", "confidence"])
+# One decoded message
+ResultMessage = namedtuple("ResultMessage", ["version", "stream_id", "frame_id", "eyes"])
+
+
+def encode_results(frame_id, eyes, stream_id=0):
+    """
+    :param frame_id: Frame identifier (attent_id) of the results.
+    :param eyes: Iterable of EyeResult.
+    :param stream_id: Headset / stream identifier.
+    :return: The encoded message (14 bytes + 36 bytes per eye).
+    """
+    eyes = list(eyes)
+    parts = [_HEADER.pack(MAGIC, SCHEMA_VERSION, len(eyes), stream_id, frame_id)]
+    for eye in eyes:
+        timestamp = math.nan if eye.timestamp is None else eye.timestamp
+        if eye.ellipse is None:
+            parts.append(_RECORD.pack(eye.eye, 0, timestamp, 0, 0, 0, 0, 0, 0))
+        else:
+            (cx, cy), (axis_a, axis_b), angle = eye.ellipse
+            parts.append(_RECORD.pack(eye.eye, _HAS_ELLIPSE, timestamp, cx, cy, axis_a, axis_b, angle,
+                                      eye.confidence))
+    return b"".join(parts)
+
+
+def decode_results(data):
+    """
+    :param data: A message produced by encode_results().
+    :return: ResultMessage with one EyeResult per eye record (timestamp None when unknown).
+    :raises ValueError: If the message is not a result message or uses an unsupported schema version.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("Result message too short")
+    magic, version, count, stream_id, frame_id = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a pupil result message")
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported result schema version {version}, expected {SCHEMA_VERSION}")
+    if len(data) < _HEADER.size + count * _RECORD.size:
+        raise ValueError("Truncated result message")
+    eyes = []
+    for offset in range(_HEADER.size, _HEADER.size + count * _RECORD.size, _RECORD.size):
+        eye, flags, timestamp, cx, cy, axis_a, axis_b, angle, confidence = _RECORD.unpack_from(data, offset)
+        ellipse = ((cx, cy), (axis_a, axis_b), angle) if flags & _HAS_ELLIPSE else None
+        eyes.append(EyeResult(eye, None if math.isnan(timestamp) else timestamp, ellipse,
+                              confidence if ellipse is not None else 0.0))
+    return ResultMessage(version, stream_id, frame_id, eyes)
@@ -0,0 +1,113 @@
+import cv2
+import numpy as np
+
+
+def scale_ellipse(ellipse, scale_x, scale_y, offset=(0, 0)):
+    """
+    Map an OpenCV ellipse ((cx, cy), (width, height), angle) through x' = (x + ox) * sx, y' = (y + oy) * sy.
+    A non-uniform scale changes the axes and the angle, so the ellipse is sampled and refitted in that case.
+    """
+    (cx, cy), (width, height), angle = ellipse
+    if scale_x == scale_y:
+        return ((cx + offset[0]) * scale_x, (cy + offset[1]) * scale_y), (width * scale_x, height * scale_y), angle
+
+    t = np.linspace(0, 2 * np.pi, 32, endpoint=False)
+    theta = np.deg2rad(angle)
+    x = width / 2 * np.cos(t)
+    y = height / 2 * np.sin(t)
+    points_x = (cx + x * np.cos(theta) - y * np.sin(theta) + offset[0]) * scale_x
+    points_y = (cy + x * np.sin(theta) + y * np.cos(theta) + offset[1]) * scale_y
+    return cv2.fitEllipse(np.stack([points_x, points_y], axis=-1).astype(np.float32))
+
+
+def window_confidence(mask, confidence):
+    """
+    Confidence of a segmentation inside a tracking window. A pupil touching the window border
+    is cut off by the crop, which scores 0 so that the next frame falls back to full-frame inference.
+    :param confidence: Confidence of the ellipse fitted on the window mask.
+    """
+    if mask[0].any() or mask[-1].any() or mask[:, 0].any() or mask[:, -1].any():
+        return 0.0
+    return float(confidence)
+
+
+def paste_window_mask(mask, origin, scale_x, scale_y, target_size):
+    """
+    Place a window mask cropped at `origin` in native pixels into an empty mask of `target_size`.
+    """
+    full_mask = np.zeros(target_size, dtype=np.uint8)
+    x1, y1 = int(round(origin[0] * scale_x)), int(round(origin[1] * scale_y))
+    x2 = min(int(round((origin[0] + mask.shape[1]) * scale_x)), target_size[1])
+    y2 = min(int(round((origin[1] + mask.shape[0]) * scale_y)), target_size[0])
+    if x2 > x1 and y2 > y1:
+        full_mask[y1:y2, x1:x2] = cv2.resize(mask, (x2 - x1, y2 - y1), interpolation=cv2.INTER_NEAREST)
+    return full_mask
+
+
+class RoiTracker:
+    """
+    Per-eye region-of-interest tracker for the fully convolutional DeepVOG model.
+    While an eye is tracked with enough confidence, its next frame is only segmented inside a window of
+    `window_size` pixels cropped at native resolution around the previous ellipse. Without a previous
+    ellipse, with low confidence, or when the pupil no longer fits the window, the eye falls back to
+    full-frame inference.
+    """
+
+    def __init__(self, window_size=(128, 128), min_confidence=0.6, max_axis_ratio=0.8):
+        """
+        :param window_size: (height, width) of the crop window in native pixels, multiples of 16.
+        :param min_confidence: Below this confidence the next frame runs full-frame.
+        :param max_axis_ratio: Largest pupil axis allowed, as a fraction of the smaller window side.
+        """
+        if window_size[0] % 16 or window_size[1] % 16:
+            raise ValueError(f"ROI window size must be a multiple of 16, got {window_size}")
+        self.window_size = tuple(window_size)
+        self.min_confidence = min_confidence
+        self.max_axis_ratio = max_axis_ratio
+        self._state = {}  # key -> (ellipse in native pixels, confidence)
+        self.window_frames = 0
+        self.full_frames = 0
+
+    def window(self, key, frame_shape):
+        """
+        Choose how to segment the next frame of an eye.
+        :param key: Eye identifier.
+        :param frame_shape: Shape of the native frame.
+        :return: (x0, y0) origin of the crop window, or None for full-frame inference.
+        """
+        origin = self._window_origin(key, frame_shape)
+        if origin is None:
+            self.full_frames += 1
+        else:
+            self.window_frames += 1
+        return origin
+
+    def _window_origin(self, key, frame_shape):
+        state = self._state.get(key)
+        if state is None:
+            return None
+        ellipse, confidence = state
+        window_h, window_w = self.window_size
+        frame_h, frame_w = frame_shape[:2]
+        if confidence < self.min_confidence or frame_h < window_h or frame_w < window_w:
+            return None
+        (cx, cy), axes, _ = ellipse
+        if max(axes) > self.max_axis_ratio * min(window_h, window_w):
+            return None
+
+        # Center the window on the last pupil, shifted back inside the frame near the edges
+        x0 = min(max(int(round(cx - window_w / 2)), 0), frame_w - window_w)
+        y0 = min(max(int(round(cy - window_h / 2)), 0), frame_h - window_h)
+        return x0, y0
+
+    def update(self, key, ellipse, confidence):
+        """
+        Record the latest ellipse (native pixels) of an eye; None marks the pupil as lost.
+        """
+        if ellipse is None:
+            self._state.pop(key, None)
+        else:
+            self._state[key] = (ellipse, confidence)
+
+    def reset(self):
+        self._state.clear()
@@ -1,32 +1,52 @@
 import zmq
-import cv2
-import time
+import threading
+from server_side.result_schema import EyeResult, encode_results
+from server_side.roi import scale_ellipse
 
 # ZeroMQ Context and Socket
 context = zmq.Context()
-socket = context.socket(zmq.PUSH)  # PUSH socket for streaming frames
+# PUB socket: each eye process of Pupil Capture subscribes and receives every result. Sending never
+# blocks, results are dropped for subscribers that fall behind their high-water mark.
+socket = context.socket(zmq.PUB)
 socket.bind("tcp://localhost:5550")  # Use the desktop's IP
+# ZMQ sockets are not thread-safe, results are sent from the inference and the tracking threads
+send_lock = threading.Lock()
 
-# Poller setup
-poller = zmq.Poller()
-poller.register(socket, zmq.POLLOUT)  # Monitor the socket for send readiness
 
+def send_info(pupil_info, attent_id, confidence=(1.0, 1.0), source_sizes=None, timestamps=(None, None),
+              stream_id=0, target_size=(240, 320), eyes=(0, 1)):
+    """
+    Publish the pupil ellipses of one frame message (an eye pair or a single eye frame), see encode_info().
+    """
+    publish(encode_info(pupil_info, attent_id, confidence, source_sizes, timestamps, stream_id, target_size, eyes))
 
-def send_info(pupil_info, attent_id):
-    # # Compress the frame using JPEG
-    # (center_x, center_y) = pupil_info0[0]  # Center of the ellipse
-    # (major_axis, minor_axis) = pupil_info0[1]  # Major and minor axis lengths
-    # angle = pupil_info0[2]  # Rotation angle of the ellipse
 
-    # Prepare the message
-    message = {
-        'info0': pupil_info[0],  # Directly include pupil_info0
-        'info1': pupil_info[1],  # Directly include pupil_info1
-        'attent_id': attent_id
-    }
+def encode_info(pupil_info, attent_id, confidence=(1.0, 1.0), source_sizes=None, timestamps=(None, None),
+                stream_id=0, target_size=(240, 320), eyes=(0, 1)):
+    """
+    Encode the pupil ellipses of one frame message (an eye pair or a single eye frame) as a binary result
+    message (see result_schema).
+    :param pupil_info: Ellipse per frame in target_size coordinates, None where no pupil was found.
+    :param confidence: Fit confidence in [0, 1] per frame.
+    :param source_sizes: (width, height) of each camera frame; the ellipses are sent in those pixel
+                         coordinates. None sends them in target_size coordinates.
+    :param timestamps: Pupil capture timestamp of each frame, None if unknown.
+    :param target_size: (height, width) the ellipses were fitted at.
+    :param eyes: Eye id of each frame.
+    :return: The encoded message.
+    """
+    results = []
+    for i, (eye, ellipse) in enumerate(zip(eyes, pupil_info)):
+        if ellipse is not None and source_sizes is not None:
+            source_width, source_height = source_sizes[i]
+            ellipse = scale_ellipse(ellipse, source_width / target_size[1], source_height / target_size[0])
+        results.append(EyeResult(eye, timestamps[i], ellipse, float(confidence[i])))
+    return encode_results(attent_id, results, stream_id)
 
-    # Use poller to check if the socket is ready for sending
-    events = dict(poller.poll(0))  # Non-blocking poll
-    if socket in events and events[socket] == zmq.POLLOUT:
-        # Send the message as JSON
-        socket.send_json(message)
+
+def publish(message):
+    """
+    Publish an encoded result message to the local subscribers (the Pupil Capture plugin).
+    """
+    with send_lock:
+        socket.send(message)
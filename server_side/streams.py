@@ -0,0 +1,58 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Stream of the frames pulled from the local client (tcp://localhost:5555), results go to the local PUB socket
+LOCAL_STREAM = 0
+# Stream ids are sent in the uint16 field of the result schema
+MAX_STREAMS = 0xFFFF
+
+
+class StreamRegistry:
+    """
+    Client streams of a multi-headset server. Every client connected to the ROUTER endpoint gets a stream
+    id the first time one of its messages arrives; results are routed back through its identity.
+    Message loss is tracked per stream, since every client numbers its own messages.
+    """
+
+    def __init__(self):
+        self._ids = {}  # ZMQ identity -> stream id
+        self._identities = {}  # stream id -> ZMQ identity
+        self._last_attent_id = {}
+        self._lock = threading.Lock()
+
+    def stream_id(self, identity):
+        """
+        :return: The stream id of a client identity, a new one for unknown clients.
+        """
+        with self._lock:
+            stream = self._ids.get(identity)
+            if stream is None:
+                if len(self._ids) >= MAX_STREAMS:
+                    raise RuntimeError(f"More than {MAX_STREAMS} client streams")
+                stream = self._ids[identity] = len(self._ids) + 1
+                self._identities[stream] = identity
+                logger.info(f"New client stream {stream}")
+            return stream
+
+    def identity(self, stream):
+        """
+        :return: The ZMQ identity of a stream, None for the local stream or unknown ids.
+        """
+        return self._identities.get(stream)
+
+    def lost_messages(self, stream, attent_id):
+        """
+        Record a message of a stream.
+        :return: Number of messages of the stream missing before this one.
+        """
+        with self._lock:
+            last = self._last_attent_id.get(stream)
+            self._last_attent_id[stream] = attent_id
+        if last is None or attent_id == last + 1:
+            return 0
+        return max(attent_id - last - 1, 0)
+
+    def __len__(self):
+        return len(self._ids)
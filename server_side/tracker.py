@@ -0,0 +1,208 @@
+import math
+import threading
+import time
+import cv2
+import numpy as np
+from server_side.roi import scale_ellipse
+
+
+class EyeTracker:
+    """
+    Tracks one pupil between CNN segmentations.
+    A constant-velocity Kalman filter on the ellipse center is corrected every frame by the median
+    Lucas-Kanade optical flow of points on the last ellipse outline; axes and angle are kept from the
+    last CNN result. CNN results arrive a few frames late, so the flow accumulated since the segmented
+    frame is added to them before they correct the filter.
+    """
+
+    def __init__(self, process_noise=1e-2, measurement_noise=0.5, outline_points=16):
+        self.kalman = cv2.KalmanFilter(4, 2)
+        self.kalman.transitionMatrix = np.array([[1, 0, 1, 0],
+                                                 [0, 1, 0, 1],
+                                                 [0, 0, 1, 0],
+                                                 [0, 0, 0, 1]], dtype=np.float32)
+        self.kalman.measurementMatrix = np.eye(2, 4, dtype=np.float32)
+        self.kalman.processNoiseCov = np.eye(4, dtype=np.float32) * process_noise
+        self.kalman.measurementNoiseCov = np.eye(2, dtype=np.float32) * measurement_noise
+        self.outline_points = outline_points
+        self.ellipse = None  # Native frame pixels
+        self.confidence = 0.0
+        self.frames_since_cnn = 0
+        self._previous_gray = None
+        self._flow_offset = np.zeros(2)  # Cumulative flow displacement, to re-base late CNN results
+        self._pending = {}  # frameID -> flow offset when the frame was sent to the CNN
+
+    def _outline(self):
+        (cx, cy), (width, height), angle = self.ellipse
+        t = np.linspace(0, 2 * np.pi, self.outline_points, endpoint=False)
+        theta = np.deg2rad(angle)
+        x, y = width / 2 * np.cos(t), height / 2 * np.sin(t)
+        points = np.stack([cx + x * np.cos(theta) - y * np.sin(theta),
+                           cy + x * np.sin(theta) + y * np.cos(theta)], axis=-1)
+        return points.reshape(-1, 1, 2).astype(np.float32)
+
+    def track(self, gray):
+        """
+        Propagate the ellipse to a new grayscale frame.
+        :return: The predicted ellipse in native pixels, or None while no pupil is known.
+        """
+        previous_gray, self._previous_gray = self._previous_gray, gray
+        self.frames_since_cnn += 1
+        if self.ellipse is None or previous_gray is None or previous_gray.shape != gray.shape:
+            return self.ellipse
+
+        points = self._outline()
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray, gray, points, None,
+                                                    winSize=(15, 15), maxLevel=2)
+        good = status.ravel() == 1
+        self.kalman.predict()
+        if good.sum() < 3:
+            self.confidence = 0.0
+            return self.ellipse
+
+        displacements = (moved - points).reshape(-1, 2)[good]
+        shift = np.median(displacements, axis=0)
+        spread = np.median(np.linalg.norm(displacements - shift, axis=1))
+        # Few tracked points or incoherent motion along the outline mean the flow is unreliable
+        self.confidence = good.mean() / (1.0 + spread)
+        self._flow_offset += shift
+
+        (cx, cy), axes, angle = self.ellipse
+        measured = np.array([[cx + shift[0]], [cy + shift[1]]], dtype=np.float32)
+        center = self.kalman.correct(measured)[:2].ravel()
+        self.ellipse = ((float(center[0]), float(center[1])), axes, angle)
+        return self.ellipse
+
+    def speed(self):
+        """
+        Estimated pupil speed in native pixels per frame.
+        """
+        return float(np.hypot(self.kalman.statePost[2, 0], self.kalman.statePost[3, 0]))
+
+    def mark_pending(self, frame_id):
+        self._pending[frame_id] = self._flow_offset.copy()
+        self.frames_since_cnn = 0
+
+    def correct(self, frame_id, ellipse):
+        """
+        Apply the CNN ellipse (native pixels) of an earlier frame; None means the pupil was not found.
+        """
+        offset = self._pending.pop(frame_id, None)
+        # Results come back in order, anything older than this frame is no longer pending
+        self._pending = {key: value for key, value in self._pending.items() if key > frame_id}
+        if ellipse is None:
+            self.ellipse = None
+            self.confidence = 0.0
+            return
+        (cx, cy), axes, angle = ellipse
+        if offset is not None:
+            shift = self._flow_offset - offset
+            cx, cy = cx + shift[0], cy + shift[1]
+        if self.ellipse is None:
+            # (Re-)acquired: start from rest at the measured position
+            self.kalman.statePost = np.array([[cx], [cy], [0], [0]], dtype=np.float32)
+            self.kalman.errorCovPost = np.eye(4, dtype=np.float32)
+        else:
+            # correct() starts from the prior of the last predict(); the flow corrections applied since then
+            # are in the posterior, so correct from the current state instead
+            self.kalman.statePre = self.kalman.statePost.copy()
+            self.kalman.errorCovPre = self.kalman.errorCovPost.copy()
+            self.kalman.correct(np.array([[cx], [cy]], dtype=np.float32))
+        self.ellipse = ((float(cx), float(cy)), axes, angle)
+        self.confidence = 1.0
+
+
+class TemporalTrackerStage:
+    """
+    Sits between the receiver and prediction: decides per frame message (pair or single eye frame) whether the CNN has to run, and
+    otherwise answers with the ellipses predicted by the per-eye trackers.
+    The CNN runs when it has not run for `skip` frames, when an eye moves faster than `motion_threshold`
+    native pixels per frame (e.g. a saccade), or when tracking confidence drops below `min_confidence`.
+    `skip` adapts to load: it is the number of frames that arrive during one CNN round trip, bounded
+    by [min_skip, max_skip].
+    """
+
+    def __init__(self, min_skip=1, max_skip=8, motion_threshold=3.0, min_confidence=0.5, target_size=(240, 320)):
+        self.min_skip = min_skip
+        self.max_skip = max_skip
+        self.skip = min_skip
+        self.motion_threshold = motion_threshold
+        self.min_confidence = min_confidence
+        self.target_size = target_size
+        self.trackers = [EyeTracker(), EyeTracker()]
+        self._frame_shapes = [None, None]
+        self._submitted = {}  # frameID -> submit time
+        self._last_step = [None, None]  # Per eye
+        self._frame_interval = None  # Exponential moving averages in seconds
+        self._cnn_latency = None
+        self._lock = threading.Lock()
+        self.cnn_frames = 0
+        self.tracked_frames = 0
+
+    def step(self, frames, frame_id, eyes=(0, 1)):
+        """
+        Track the frames of a new message, a pair or a single eye frame.
+        :param eyes: Eye id of each frame.
+        :return: pupil_info in target_size coordinates when every frame was tracked without the CNN,
+                 or None when the message has to go through the CNN.
+        """
+        grays = [frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames]
+        with self._lock:
+            now = time.monotonic()
+            for eye in eyes:
+                # `skip` counts frames of one eye, whether the eyes arrive paired or one by one
+                if self._last_step[eye] is not None:
+                    self._frame_interval = _ema(self._frame_interval, now - self._last_step[eye])
+                self._last_step[eye] = now
+
+            predicted = []
+            needs_cnn = False
+            for eye, gray in zip(eyes, grays):
+                tracker = self.trackers[eye]
+                self._frame_shapes[eye] = gray.shape
+                predicted.append(tracker.track(gray))
+                needs_cnn |= (tracker.ellipse is None or tracker.frames_since_cnn >= self.skip or
+                              tracker.confidence < self.min_confidence or tracker.speed() > self.motion_threshold)
+
+            if needs_cnn:
+                for eye in eyes:
+                    self.trackers[eye].mark_pending(frame_id)
+                self._submitted[frame_id] = now
+                self.cnn_frames += 1
+                return None
+
+            self.tracked_frames += 1
+            return [self._to_target(ellipse, eye) for eye, ellipse in zip(eyes, predicted)]
+
+    def on_cnn_result(self, frame_id, pupil_info, eyes=(0, 1)):
+        """
+        Feed the CNN ellipses (target_size coordinates) of a message that step() sent to the CNN.
+        """
+        with self._lock:
+            submitted = self._submitted.pop(frame_id, None)
+            # Results come back in order, older messages failed or were dropped and will never return
+            self._submitted = {key: value for key, value in self._submitted.items() if key > frame_id}
+            if submitted is not None:
+                self._cnn_latency = _ema(self._cnn_latency, time.monotonic() - submitted)
+                self._adapt()
+            for eye, ellipse in zip(eyes, pupil_info):
+                frame_h, frame_w = self._frame_shapes[eye]
+                native = None if ellipse is None else scale_ellipse(
+                    ellipse, frame_w / self.target_size[1], frame_h / self.target_size[0])
+                self.trackers[eye].correct(frame_id, native)
+
+    def _adapt(self):
+        if self._cnn_latency is None or not self._frame_interval:
+            return
+        skip = math.ceil(self._cnn_latency / self._frame_interval)
+        self.skip = min(max(skip, self.min_skip), self.max_skip)
+
+    def _to_target(self, ellipse, eye):
+        if ellipse is None:
+            return None
+        frame_h, frame_w = self._frame_shapes[eye]
+        return scale_ellipse(ellipse, self.target_size[1] / frame_w, self.target_size[0] / frame_h)
+
+
+def _ema(average, value, alpha=0.1):
+    return value if average is None else (1 - alpha) * average + alpha * value
@@ -0,0 +1,213 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+# TensorFlow is only imported by the worker processes (through prediction), the pool itself stays light
+logger = logging.getLogger(__name__)
+
+
+def split_cores(workers, cores=None):
+    """
+    Split the CPU cores this process may run on into `workers` disjoint, equally sized subsets.
+    :return: One list of core ids per worker; workers share cores only when there are fewer cores than workers.
+    """
+    if cores is None:
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else \
+            list(range(os.cpu_count() or 1))
+    per_worker = max(len(cores) // workers, 1)
+    return [cores[(i * per_worker) % len(cores):(i * per_worker) % len(cores) + per_worker] for i in range(workers)]
+
+
+def _worker_main(cores, threads, backend, backend_options, shm_name, capacity, target_size, connection):
+    """
+    Entry point of a model replica: pin to `cores`, load the model with `threads` intra-op threads,
+    then segment the frames the pool writes into the shared memory block until told to stop.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the whole process group, the pool stops us
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    # Set before TensorFlow / ONNX Runtime are imported, the backends read them at initialization
+    for variable in ("OMP_NUM_THREADS", "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS"):
+        os.environ[variable] = str(threads if variable != "TF_NUM_INTEROP_THREADS" else 1)
+    cv2.setNumThreads(1)
+    block = shared_memory.SharedMemory(name=shm_name)
+    frames = masks = None
+    try:
+        from server_side import prediction
+        prediction.load_model_once(backend, num_threads=threads, **backend_options)
+        # Frames reach the replica already at the network size
+        prediction.warmup((1, 2, capacity), target_size, (target_size[1], target_size[0]))
+        frames, masks = _views(block, capacity, target_size)
+        connection.send(("ready", os.getpid()))
+        while True:
+            task = connection.recv()
+            if task is None:
+                break
+            count, eyes, return_masks = task
+            try:
+                batch_masks, ellipses, confidences = prediction.segment_frames(
+                    prediction.model, list(frames[:count]), eyes, target_size)
+                if return_masks:
+                    masks[:count] = batch_masks
+                connection.send(("ok", ellipses, [float(confidence) for confidence in confidences]))
+            except Exception as e:
+                connection.send(("error", repr(e)))
+    except Exception as e:
+        connection.send(("error", repr(e)))
+    finally:
+        del frames, masks
+        block.close()
+
+
+def _views(block, capacity, target_size):
+    """
+    :return: (frames, masks): uint8 (capacity, H, W) views on the two halves of a worker's shared memory.
+    """
+    shape = (capacity,) + tuple(target_size)
+    size = int(np.prod(shape))
+    return (np.ndarray(shape, dtype=np.uint8, buffer=block.buf[:size]),
+            np.ndarray(shape, dtype=np.uint8, buffer=block.buf[size:2 * size]))
+
+
+class _Worker:
+    def __init__(self, index, process, connection, block, frames, masks):
+        self.index = index
+        self.process = process
+        self.connection = connection
+        self.block = block
+        self.frames = frames
+        self.masks = masks
+        self.batches = 0
+        self.frames_segmented = 0
+
+
+class InferenceWorkerPool:
+    """
+    Model replicas in separate processes, each pinned to its own subset of the CPU cores with its own
+    thread settings, so inference scales with the cores instead of one model call at a time.
+    Frames reach a worker through a shared memory block (grayscale, already at the network size) and only
+    the ellipses, confidences and optionally the masks come back. segment_frames() blocks the calling
+    thread until its worker answers: call it from as many threads as there are workers (e.g. a pipeline
+    Stage with `workers` threads, whose reorder buffer keeps the results in arrival order).
+    """
+
+    def __init__(self, workers, backend="keras", backend_options=None, max_frames=16, target_size=(240, 320),
+                 threads=None, return_masks=True):
+        """
+        :param workers: Number of model replicas.
+        :param backend_options: Options of deepvog.load_backend, except num_threads.
+        :param max_frames: Frames one call hands to a worker at once, larger calls are split.
+        :param threads: Intra-op threads per replica, default the number of cores it is pinned to.
+        :param return_masks: Copy the masks back (for the preview), otherwise masks are None.
+        """
+        self.workers = workers
+        self.backend = backend
+        self.backend_options = dict(backend_options or {})
+        self.backend_options.pop("num_threads", None)
+        self.max_frames = max_frames
+        self.target_size = tuple(target_size)
+        self.threads = threads
+        self.return_masks = return_masks
+        self._workers = []
+        self._idle = queue.Queue()
+
+    def start(self):
+        """
+        Spawn the replicas and wait until every one has loaded and warmed up its model. The first replica
+        starts alone, so a missing cached model is built once and the others load it.
+        """
+        context = multiprocessing.get_context("spawn")
+        block_size = 2 * self.max_frames * self.target_size[0] * self.target_size[1]
+        for index, cores in enumerate(split_cores(self.workers)):
+            threads = self.threads or len(cores)
+            block = shared_memory.SharedMemory(create=True, size=block_size)
+            parent, child = context.Pipe()
+            process = context.Process(
+                target=_worker_main, name=f"inference-worker-{index}", daemon=True,
+                args=(cores, threads, self.backend, self.backend_options, block.name, self.max_frames,
+                      self.target_size, child))
+            process.start()
+            frames, masks = _views(block, self.max_frames, self.target_size)
+            self._workers.append(_Worker(index, process, parent, block, frames, masks))
+            logger.info(f"Inference worker {index}: cores {cores}, {threads} threads")
+            if index == 0:
+                self._wait_ready(self._workers[0])
+        for worker in self._workers[1:]:
+            self._wait_ready(worker)
+        return self
+
+    def _wait_ready(self, worker):
+        try:
+            reply = worker.connection.recv()
+        except EOFError:
+            reply = ("error", f"exited with code {worker.process.exitcode}")
+        if reply[0] != "ready":
+            self.close()
+            raise RuntimeError(f"Inference worker {worker.index} failed to start: {reply[1]}")
+        self._idle.put(worker)
+
+    def segment_frames(self, frames, eyes):
+        """
+        Same contract as prediction.segment_frames, on the next idle replica.
+        :return: (masks, ellipses, confidences), masks None when the pool does not return them.
+        """
+        worker = self._idle.get()
+        try:
+            masks, ellipses, confidences = [], [], []
+            for start in range(0, len(frames), self.max_frames):
+                chunk = frames[start:start + self.max_frames]
+                for frame, slot in zip(chunk, worker.frames):
+                    self._write(frame, slot)
+                worker.connection.send((len(chunk), list(eyes[start:start + self.max_frames]), self.return_masks))
+                reply = worker.connection.recv()
+                if reply[0] != "ok":
+                    raise RuntimeError(f"Inference worker {worker.index}: {reply[1]}")
+                ellipses += reply[1]
+                confidences += reply[2]
+                # The masks are copied out, the shared block is overwritten by the next call
+                masks += list(worker.masks[:len(chunk)].copy()) if self.return_masks else [None] * len(chunk)
+                worker.batches += 1
+                worker.frames_segmented += len(chunk)
+            return masks, ellipses, np.asarray(confidences, dtype=np.float32)
+        finally:
+            self._idle.put(worker)
+
+    def _write(self, frame, slot):
+        """
+        Convert a frame to grayscale at the network size straight into its shared memory slot.
+        Eye cameras are infrared, so the color channels carry the same image.
+        """
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if frame.shape[:2] == self.target_size:
+            np.copyto(slot, frame)
+        else:
+            cv2.resize(frame, (self.target_size[1], self.target_size[0]), dst=slot, interpolation=cv2.INTER_AREA)
+
+    def stats(self):
+        """
+        :return: Batches and frames segmented by each replica.
+        """
+        return [{"worker": worker.index, "batches": worker.batches, "frames": worker.frames_segmented}
+                for worker in self._workers]
+
+    def close(self):
+        for worker in self._workers:
+            try:
+                worker.connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self._workers:
+            worker.process.join(timeout=5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            del worker.frames, worker.masks
+            worker.block.close()
+            worker.block.unlink()
+        self._workers = []